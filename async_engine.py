@@ -0,0 +1,119 @@
+import asyncio
+import socket
+import time
+
+import protocol
+
+
+class AsyncEngine:
+    def __init__(self, server):
+        self.server = server
+        self.log = server.log
+        self.loop: asyncio.AbstractEventLoop | None = None
+        # The loop only keeps weak references to tasks; adopted sessions are held here.
+        self.adopted: set[asyncio.Task] = set()
+
+    def run(self, sock: socket.socket):
+        asyncio.run(self.main(sock))
+
+    async def main(self, sock: socket.socket):
+        self.loop = asyncio.get_running_loop()
+        sock.setblocking(False)
+        srv = await asyncio.start_server(self.handler_connection, sock=sock)
+        async with srv:
+            await srv.serve_forever()
+
+    async def handler_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info("peername")
+        frames = protocol.AsyncFrameReader(reader)
+        try:
+            data, framed = await frames.read_message()
+            if data is None:
+                return
+
+            if self.server.is_remote(data):
+                self.server.peer_connections.inc()
+                try:
+                    while data is not None:
+                        started = time.perf_counter()
+                        if self.server.may_block(data):
+                            res = await asyncio.to_thread(self.server.execute_remote, data)
+                        else:
+                            res = self.server.execute_remote(data)
+                        if res is not None:
+                            await protocol.respond_async(writer, res, framed, rid=frames.rid)
+                        self.server.observe(data, time.perf_counter() - started)
+                        data, framed = await frames.read_message()
+                finally:
+                    self.server.peer_connections.dec()
+                return
+
+            if not self.server.admit_session():
+                self.log.warning(f"Client {addr} refused: too many sessions")
+                await protocol.respond_async(writer, self.server.busy(), framed)
+                return
+
+            await self.serve_client(frames, writer, protocol.Session(addr), data, framed)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            self.log.exception(f"Connection handler error: {e}")
+        finally:
+            writer.close()
+
+    async def serve_client(self, frames: protocol.AsyncFrameReader, writer: asyncio.StreamWriter,
+                           session: protocol.Session, data: bytes | None = None, framed: bool = False):
+        self.log.info(f"Client {session.addr} connected")
+        self.server.sessions.inc()
+        try:
+            if data is None:
+                data, framed = await frames.read_message()
+            while data is not None:
+                started = time.perf_counter()
+                if self.server.may_block(data):
+                    res = await asyncio.to_thread(self.server.execute, session, data)
+                else:
+                    res = self.server.execute(session, data)
+                if session.handoff is not None:
+                    sock = writer.get_extra_info("socket")
+                    if self.server.hand_off(sock, session, res, framed, frames.rid, bytes(frames.buf)):
+                        break
+                    res, session.closed = self.server.busy(), True
+                await protocol.respond_async(writer, res, framed, session.compress, frames.rid)
+                elapsed = time.perf_counter() - started
+                self.server.latency.record(elapsed)
+                self.server.observe(data, elapsed)
+                if session.closed or self.server.stop_event.is_set():
+                    break
+                data, framed = await frames.read_message()
+        finally:
+            self.server.sessions.dec()
+            self.log.info(f"Client {session.addr} disconnected")
+
+    def adopt(self, sock: socket.socket, session: protocol.Session, reply: bytes, framed: bool, rid: int | None,
+              buffered: bytes):
+        # Called from the handoff thread with a client socket another worker passed over.
+        if self.loop is None:
+            sock.close()
+            return
+        self.loop.call_soon_threadsafe(self._start_resume, sock, session, reply, framed, rid, buffered)
+
+    def _start_resume(self, *args):
+        task = self.loop.create_task(self.resume(*args))
+        self.adopted.add(task)
+        task.add_done_callback(self.adopted.discard)
+
+    async def resume(self, sock: socket.socket, session: protocol.Session, reply: bytes, framed: bool,
+                     rid: int | None, buffered: bytes):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        frames = protocol.AsyncFrameReader(reader)
+        frames.buf += buffered
+        try:
+            await protocol.respond_async(writer, reply, framed, session.compress, rid)
+            await self.serve_client(frames, writer, session)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            self.log.exception(f"Connection handler error: {e}")
+        finally:
+            writer.close()
@@ -0,0 +1,747 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from datetime import datetime, timezone
+
+import protocol
+import records
+from dns_client import DNSClient
+from mail_cache import MailCache
+from mail_client import MailClient
+from mailid import SEQ_BITS, SEQ_MASK, MailIdGenerator, timestamp_ms
+from mailstore import MailStore
+
+USERS = {"u1": "p1", "u2": "p2", "u3": "p3", "u4": "p4"}
+OPS = ("list", "read", "send", "delete")
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def summarize(samples: list[float], elapsed: float | None = None) -> dict:
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0}
+
+    def pct(p):
+        return round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 3)
+
+    res = {
+        "count": len(samples),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+        "p50_ms": pct(0.5),
+        "p90_ms": pct(0.9),
+        "p99_ms": pct(0.99),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+    if elapsed:
+        res["per_sec"] = round(len(samples) / elapsed, 1)
+    return res
+
+
+def git_revision() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+class Cluster:
+    # A registry and N mail servers as child processes, so the load generator does not
+    # share a GIL with what it measures.
+    def __init__(self, servers: int, engine: str, storage: str, fsync: str, extra: list[str], log_dir: str | None,
+                 workers: int = 1):
+        self.count = servers
+        self.workers = workers
+        self.engine = engine
+        self.storage = storage
+        self.fsync = fsync
+        self.extra = extra
+        self.log_dir = log_dir
+        self.dns_port = free_port()
+        self.servers: dict[str, int] = {}
+        self.procs: list[subprocess.Popen] = []
+        self.data_dir = tempfile.mkdtemp(prefix="bench-") if storage == "log" else None
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+
+    def _spawn(self, name: str, args: list[str]):
+        out = open(os.path.join(self.log_dir, f"{name}.log"), "w") if self.log_dir else subprocess.DEVNULL
+        self.procs.append(subprocess.Popen([sys.executable, *args], cwd=HERE, stdout=out, stderr=subprocess.STDOUT))
+
+    def start(self, timeout: float = 15.0):
+        self._spawn("dns", ["dns.py", "--port", str(self.dns_port)])
+        for i in range(self.count):
+            name, port = f"S{i + 1}", free_port()
+            self.servers[name] = port
+            args = ["server.py", name, str(port), "--engine", self.engine, "--storage", self.storage,
+                    "--fsync", self.fsync, "--dns", f"127.0.0.1:{self.dns_port}", "--workers", str(self.workers)]
+            if self.data_dir:
+                args += ["--data-dir", os.path.join(self.data_dir, name)]
+            self._spawn(name, args + self.extra)
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                with DNSClient("127.0.0.1", self.dns_port, timeout=1.0) as dns:
+                    if set(dns.list()) >= set(self.servers):
+                        return
+            except OSError:
+                pass
+            time.sleep(0.1)
+        self.stop()
+        raise RuntimeError("cluster did not come up")
+
+    def stop(self):
+        for proc in self.procs:
+            proc.terminate()
+        for proc in self.procs:
+            try:
+                proc.wait(5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if self.data_dir:
+            shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+class Tracker:
+    # Remote SENDs are tagged with a token in the subject; watchers stamp when it shows up
+    # in the receiver's mailbox.
+    def __init__(self):
+        self.sent: dict[str, float] = {}
+        self.arrived: dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def send(self, token: str):
+        with self.lock:
+            self.sent[token] = time.perf_counter()
+
+    def arrive(self, token: str):
+        now = time.perf_counter()
+        with self.lock:
+            if token in self.sent and token not in self.arrived:
+                self.arrived[token] = now - self.sent[token]
+
+    def seen(self, token: str) -> bool:
+        with self.lock:
+            return token in self.arrived
+
+    def pending(self) -> int:
+        with self.lock:
+            return len(self.sent) - len(self.arrived)
+
+
+def watch_mailbox(port: int, user: str, tracker: Tracker, stop: threading.Event, poll: float):
+    with protocol.Connection.open(("127.0.0.1", port)) as conn:
+        conn.request(f"LOGIN::{user}::{USERS[user]}".encode())
+        since = 0
+        while not stop.is_set():
+            delta = json.loads(conn.request(f"LIST::SINCE::{since}".encode()))
+            since = delta["version"]
+            for mail in delta.get("added", ()):
+                if mail["subject"].startswith("bench:"):
+                    tracker.arrive(mail["subject"])
+            stop.wait(poll)
+
+
+def run_client(idx: int, cluster: Cluster, args, tracker: Tracker, stop: threading.Event, results: dict):
+    rnd = random.Random(idx)
+    names = list(cluster.servers)
+    home = names[idx % len(names)]
+    user = list(USERS)[idx % len(USERS)]
+    weights = [args.mix[op] for op in OPS]
+    body = "x" * args.body_size
+    latencies = {op: [] for op in OPS}
+    errors = {op: 0 for op in OPS}
+    known: list[tuple[str, str]] = []
+
+    with protocol.Connection.open(("127.0.0.1", cluster.servers[home])) as conn:
+        if args.compress:
+            conn.login(user, USERS[user])
+        else:
+            conn.request(f"LOGIN::{user}::{USERS[user]}".encode())
+        seq = 0
+        while not stop.is_set():
+            op = rnd.choices(OPS, weights)[0]
+            if op in ("read", "delete") and not known:
+                op = "list"
+            started = time.perf_counter()
+
+            if op == "list":
+                page = json.loads(conn.request(b"LIST::50::"))
+                known = [(m["id"], m["subject"]) for m in page["mails"]]
+                ok = True
+            elif op == "read":
+                mid, _ = rnd.choice(known)
+                ok = conn.request(f"READ::{mid}".encode()).startswith(b"READ_OK")
+            elif op == "delete":
+                # Leave tracked mail alone until its arrival has been stamped.
+                mid, subject = known.pop(rnd.randrange(len(known)))
+                if subject.startswith("bench:") and not tracker.seen(subject):
+                    continue
+                ok = conn.request(f"DELETE::{mid}".encode()) == b"DELETE_OK"
+            else:
+                remote = len(names) > 1 and rnd.random() < args.remote_ratio
+                target = rnd.choice([n for n in names if n != home]) if remote else home
+                to = f"{rnd.choice(list(USERS))}@{target}"
+                seq += 1
+                subject = f"bench:{idx}:{seq}" if remote else f"local:{idx}:{seq}"
+                res = conn.request(f"SEND::{to}::{subject}::{body}".encode())
+                ok = res in (b"SEND_OK", b"SEND_QUEUED")
+                if res == b"SEND_QUEUED":
+                    tracker.send(subject)
+
+            elapsed = time.perf_counter() - started
+            if ok:
+                latencies[op].append(elapsed)
+            else:
+                errors[op] += 1
+        conn.request(b"LOGOUT")
+
+    results[idx] = (latencies, errors)
+
+
+def server_stats(cluster: Cluster) -> dict:
+    stats = {}
+    for name, port in cluster.servers.items():
+        try:
+            with protocol.Connection.open(("127.0.0.1", port), timeout=5) as conn:
+                stats[name] = json.loads(conn.request(b"STATS"))
+        except Exception as e:
+            stats[name] = {"error": str(e)}
+    return stats
+
+
+def parse_mix(text: str) -> dict[str, float]:
+    mix = dict.fromkeys(OPS, 0.0)
+    for part in text.split(","):
+        op, weight = part.split("=")
+        if op not in mix:
+            raise argparse.ArgumentTypeError(f"unknown op in mix: {op}")
+        mix[op] = float(weight)
+    return mix
+
+
+def cmd_cluster(args) -> dict:
+    cluster = Cluster(args.servers, args.engine, args.storage, args.fsync, args.server_arg, args.log_dir, args.workers)
+    cluster.start()
+    tracker = Tracker()
+    stop, watch_stop = threading.Event(), threading.Event()
+    results: dict[int, tuple] = {}
+    try:
+        watchers = [
+            threading.Thread(target=watch_mailbox, args=(port, user, tracker, watch_stop, args.poll), daemon=True)
+            for port in cluster.servers.values() for user in USERS
+        ]
+        clients = [
+            threading.Thread(target=run_client, args=(i, cluster, args, tracker, stop, results), daemon=True)
+            for i in range(args.clients)
+        ]
+        for t in watchers + clients:
+            t.start()
+
+        started = time.perf_counter()
+        time.sleep(args.duration)
+        stop.set()
+        for t in clients:
+            t.join()
+        elapsed = time.perf_counter() - started
+
+        deadline = time.monotonic() + args.drain
+        while tracker.pending() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        watch_stop.set()
+        stats = server_stats(cluster)
+    finally:
+        stop.set()
+        watch_stop.set()
+        cluster.stop()
+
+    ops, total = {}, 0
+    for op in OPS:
+        samples = [s for lat, _ in results.values() for s in lat[op]]
+        ops[op] = summarize(samples, elapsed)
+        ops[op]["errors"] = sum(err[op] for _, err in results.values())
+        total += len(samples)
+
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "func"},
+        "revision": git_revision(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_sec": round(total / elapsed, 1),
+        "ops": ops,
+        "delivery": {**summarize(list(tracker.arrived.values())), "undelivered": tracker.pending()},
+        "servers": stats,
+    }
+
+
+def sample_mails(count: int, body_size: int) -> list[dict]:
+    rnd = random.Random(0)
+    now = datetime.now(timezone.utc)
+    return [{
+        "type": "MAIL_TRANSFER",
+        "id": f"mail_{int(now.timestamp() * 1000) + i}",
+        "sender": f"{rnd.choice(list(USERS))}@S1",
+        "receiver": rnd.choice(list(USERS)),
+        "subject": f"subject {i} " + "s" * rnd.randrange(8, 40),
+        "body": "".join(rnd.choice("abcdefghij klmnop\n") for _ in range(body_size)),
+        "date": now.isoformat(),
+    } for i in range(count)]
+
+
+def best_of(repeat: int, fn) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def cmd_serde(args) -> dict:
+    # MAIL_BATCH payloads and single READ records, JSON against records.py.
+    mails = sample_mails(args.count, args.body_size)
+    codecs = {
+        "json": (lambda m: json.dumps({"type": "MAIL_BATCH", "mails": m}).encode(),
+                 lambda data: json.loads(data)["mails"],
+                 lambda mail: json.dumps(mail).encode(),
+                 json.loads),
+        "binary": (records.encode_batch, records.decode_batch,
+                   records.encode, lambda data: records.decode(data)[0]),
+    }
+    result = {}
+    for name, (enc_batch, dec_batch, enc_one, dec_one) in codecs.items():
+        batch = enc_batch(mails)
+        singles = [enc_one(m) for m in mails]
+        if dec_batch(batch) != mails or [dec_one(d) for d in singles] != mails:
+            raise RuntimeError(f"{name} codec does not round-trip")
+        per_mail = 1e6 / len(mails)
+        result[name] = {
+            "batch_bytes": len(batch),
+            "batch_encode_us_per_mail": round(best_of(args.repeat, lambda: enc_batch(mails)) * per_mail, 3),
+            "batch_decode_us_per_mail": round(best_of(args.repeat, lambda: dec_batch(batch)) * per_mail, 3),
+            "record_encode_us": round(best_of(args.repeat, lambda: [enc_one(m) for m in mails]) * per_mail, 3),
+            "record_decode_us": round(best_of(args.repeat, lambda: [dec_one(d) for d in singles]) * per_mail, 3),
+        }
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "func"},
+        "revision": git_revision(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "codecs": result,
+    }
+
+
+WORDS = ("meeting", "report", "budget", "review", "draft", "schedule", "team", "update", "project", "notes",
+         "please", "thanks", "attached", "today", "tomorrow", "question", "deadline", "release", "client", "call")
+
+
+def stored_mails(count: int, body_size: int, users: int):
+    # Fresh string objects per mail, as if each had just been decoded off the wire.
+    rnd = random.Random(0)
+    base = int(time.time() * 1000)
+    for i in range(count):
+        yield {
+            "type": "MAIL_TRANSFER",
+            "id": f"mail_{base + i}",
+            "sender": f"user{rnd.randrange(1000)}@S{rnd.randrange(1, 4)}",
+            "receiver": f"u{i % users}",
+            "subject": f"{rnd.choice(WORDS)} {rnd.choice(WORDS)} {rnd.choice(WORDS)}",
+            "body": " ".join(rnd.choices(WORDS, k=body_size // 4 + 1))[:body_size],
+            "date": datetime.fromtimestamp(base / 1000 + i, timezone.utc).isoformat(),
+        }
+
+
+def dict_layout(mails) -> dict:
+    # Stored mail as it was kept before records.MailRecord: the mail dict itself, large bodies zlib bytes.
+    boxes: dict[str, dict[str, dict]] = {}
+    for mail in mails:
+        body = mail["body"]
+        if len(body) >= records.BODY_COMPRESS_MIN:
+            packed = zlib.compress(body.encode())
+            if len(packed) < len(body):
+                mail = {**mail, "body": packed}
+        boxes.setdefault(mail["receiver"], {})[mail["id"]] = mail
+    return boxes
+
+
+def record_layout(mails) -> dict:
+    boxes: dict[str, dict[str, records.MailRecord]] = {}
+    for mail in mails:
+        boxes.setdefault(mail["receiver"], {})[mail["id"]] = records.MailRecord.from_mail(mail)
+    return boxes
+
+
+def store_layout(mails) -> MailStore:
+    # Everything a mailbox server keeps per mail: record, paging order and search postings.
+    store = MailStore()
+    for mail in mails:
+        store.deliver(mail["receiver"], mail, journal=False)
+    return store
+
+
+LAYOUTS = {"dict": dict_layout, "record": record_layout, "store": store_layout}
+
+
+def cmd_memory(args) -> dict:
+    result = {}
+    for name in args.layout or LAYOUTS:
+        tracemalloc.start()
+        started = time.perf_counter()
+        kept = LAYOUTS[name](stored_mails(args.count, args.body_size, args.users))
+        elapsed = time.perf_counter() - started
+        used, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del kept
+        result[name] = {
+            "bytes": used,
+            "bytes_per_mail": round(used / args.count, 1),
+            "build_s": round(elapsed, 3),
+        }
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "func"},
+        "revision": git_revision(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "layouts": result,
+    }
+
+
+def cmd_ids(args) -> dict:
+    gen = MailIdGenerator("bench")
+    # By default the counter starts so the run crosses a 24-bit sequence wrap halfway through.
+    seq_start = SEQ_MASK - args.count // 2 if args.seq_start is None else args.seq_start
+    gen._seq = itertools.count(seq_start)
+    per_thread: list[list[str]] = [[] for _ in range(args.threads)]
+
+    def run(out: list[str]):
+        out.extend(gen() for _ in range(args.count // args.threads))
+
+    threads = [threading.Thread(target=run, args=(out,)) for out in per_thread]
+    wall_started = time.time_ns() // 1_000_000
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    wall_ended = time.time_ns() // 1_000_000
+    total = sum(map(len, per_thread))
+    # Ids are ordered per thread, so the first and last of each bound the rest: all must carry a
+    # creation time inside the run (1 ms slack for the wall/monotonic anchor, plus 1 ms per
+    # sequence wrap carried into the millisecond part).
+    carries = (seq_start + total) >> SEQ_BITS
+    stamps = [timestamp_ms(out[i]) for out in per_thread for i in (0, -1) if out]
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "func"},
+        "revision": git_revision(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "ids_per_sec": round(total / elapsed, 1),
+        "unique": len({i for out in per_thread for i in out}) == total,
+        "ordered_per_thread": all(out == sorted(out) for out in per_thread),
+        "timestamps_in_run": all(s is not None and wall_started - 1 <= s <= wall_ended + 1 + carries for s in stamps),
+    }
+
+
+class DelayProxy:
+    # TCP relay that holds every chunk for rtt/2 in each direction, standing in for a far-away
+    # datacenter. Ordering is kept per direction; bandwidth is not limited.
+    def __init__(self, target: tuple[str, int], rtt: float):
+        self.target = target
+        self.delay = rtt / 2
+        self.port = free_port()
+        self.ready = threading.Event()
+
+    def start(self):
+        threading.Thread(target=asyncio.run, args=(self.main(),), daemon=True).start()
+        self.ready.wait(5)
+
+    async def main(self):
+        srv = await asyncio.start_server(self.relay, "127.0.0.1", self.port)
+        self.ready.set()
+        async with srv:
+            await srv.serve_forever()
+
+    async def relay(self, client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection(*self.target)
+        await asyncio.gather(self.pump(client_reader, server_writer), self.pump(server_reader, client_writer))
+
+    async def pump(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def deliver():
+            while (item := await queue.get())[1]:
+                await asyncio.sleep(max(0.0, item[0] - loop.time()))
+                writer.write(item[1])
+                await writer.drain()
+            writer.close()
+
+        sender = asyncio.create_task(deliver())
+        try:
+            while data := await reader.read(65536):
+                queue.put_nowait((loop.time() + self.delay, data))
+        except ConnectionError:
+            pass
+        queue.put_nowait((0.0, b""))
+        await sender
+
+
+def cmd_pipeline(args) -> dict:
+    # Time to fetch a page of mail bodies over an RTT: one READ per round trip vs all in flight.
+    cluster = Cluster(1, args.engine, "memory", "always", [], args.log_dir)
+    cluster.start()
+    try:
+        port = cluster.servers["S1"]
+        with protocol.Connection.open(("127.0.0.1", port)) as conn:
+            conn.login("u1", USERS["u1"])
+            for i in range(args.count):
+                conn.request(f"SEND::u1@S1::pipeline {i}::{'x' * args.body_size}".encode())
+        proxy = DelayProxy(("127.0.0.1", port), args.rtt / 1000)
+        proxy.start()
+
+        with MailClient(("127.0.0.1", proxy.port)) as client:
+            client.login("u1", USERS["u1"])
+            mids = [m["id"] for m in client.list(args.count)["mails"]]
+            started = time.perf_counter()
+            lockstep = [client.read(mid) for mid in mids]
+            lockstep_s = time.perf_counter() - started
+            started = time.perf_counter()
+            futures = client.read_many(mids)
+            pipelined = [f.result() for f in futures.values()]
+            pipelined_s = time.perf_counter() - started
+        if pipelined != lockstep or None in pipelined:
+            raise RuntimeError("pipelined READs did not return the same mails")
+    finally:
+        cluster.stop()
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "func"},
+        "revision": git_revision(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "reads": len(mids),
+        "lockstep_ms": round(lockstep_s * 1000, 1),
+        "pipelined_ms": round(pipelined_s * 1000, 1),
+        "speedup": round(lockstep_s / pipelined_s, 1),
+    }
+
+
+class CountingClient(MailClient):
+    # Tallies requests sent (also per command) and reply bytes received; only the reader thread
+    # adds to received.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = 0
+        self.received = 0
+        self.commands: dict[str, int] = {}
+
+    def submit(self, payload: bytes):
+        fut = super().submit(payload)
+        self.requests += 1
+        cmd = payload.split(b"::", 1)[0].decode()
+        self.commands[cmd] = self.commands.get(cmd, 0) + 1
+        fut.add_done_callback(self._count)
+        return fut
+
+    def _count(self, fut):
+        if fut.exception() is None:
+            self.received += len(fut.result())
+
+
+def gui_session(client: CountingClient, cache: MailCache | None, user: str, args) -> dict:
+    # Replays what the GUIs do. Without a cache (the GUIs before it) every inbox view, send and
+    # delete is followed by a full LIST and every click is a READ. With one, an inbox view is a
+    # SINCE delta plus a prefetch of the first page, reads are served locally where possible, and
+    # only a send to ourselves resyncs; a delete just drops the mail from the local view.
+    rng = random.Random(args.seed)
+    ops, weights = zip(*args.mix.items())
+
+    def inbox() -> list[dict]:
+        if cache is None:
+            return json.loads(client.request(b"LIST"))
+        view = cache.sync()
+        cache.prefetch(m["id"] for m in view[:args.prefetch])
+        return view
+
+    def after_change(resync: bool) -> list[dict]:
+        if cache is None or resync:
+            return inbox()
+        return cache.view()
+
+    view = inbox()
+    for _ in range(args.actions):
+        op = rng.choices(ops, weights)[0]
+        if op == "read" and view:
+            mid = rng.choice(view[:args.hot])["id"]
+            mail = client.read(mid) if cache is None else cache.read(mid)
+            if mail is None or mail["id"] != mid:
+                raise RuntimeError(f"READ {mid} came back wrong")
+        elif op == "delete" and view:
+            mid = rng.choice(view[:args.hot])["id"]
+            if not (client.delete(mid) if cache is None else cache.delete(mid)):
+                raise RuntimeError(f"DELETE {mid} failed")
+            view = after_change(False)
+        elif op == "send":
+            to_self = rng.random() < args.self_send
+            to = f"{user}@S1" if to_self else "u3@S1"
+            client.send_mail(to, f"note {rng.randrange(1 << 30)}", "x" * args.body_size)
+            view = after_change(to_self)
+        else:
+            view = inbox()
+    return {"requests": client.requests, "received_bytes": client.received, "mails": len(view),
+            "commands": client.commands}
+
+
+def cmd_cache(args) -> dict:
+    # Requests and reply bytes for the same GUI session with and without the client cache, and
+    # for opening the inbox cold vs warm from the cache file.
+    cluster = Cluster(1, args.engine, "memory", "always", [], args.log_dir)
+    cluster.start()
+    tmp = tempfile.mkdtemp(prefix="mail-cache-")
+    try:
+        address = ("127.0.0.1", cluster.servers["S1"])
+        with MailClient(address) as seeder:
+            for user in ("u1", "u2"):
+                seeder.login(user, USERS[user])
+                futures = [seeder.submit(f"SEND::{user}@S1::seed {i}::{'x' * args.body_size}".encode())
+                           for i in range(args.mails)]
+                [f.result() for f in futures]
+
+        with CountingClient(address) as client:
+            client.login("u1", USERS["u1"])
+            plain = gui_session(client, None, "u1", args)
+
+        path = os.path.join(tmp, "u2.cache")
+        with CountingClient(address) as client:
+            client.login("u2", USERS["u2"])
+            cache = MailCache(client, path, args.max_bytes)
+            cached = gui_session(client, cache, "u2", args)
+            cached.update(cache.stats())
+            cache.save()
+        if cached["mails"] != plain["mails"]:
+            raise RuntimeError("sessions ended with different mailbox sizes")
+
+        startup = {}
+        for name, cache_file in (("cold", None), ("warm", path)):
+            with CountingClient(address) as client:
+                client.login("u2", USERS["u2"])
+                client.requests = client.received = 0
+                started = time.perf_counter()
+                cache = MailCache(client, cache_file, args.max_bytes)
+                view = cache.sync()
+                [f.result() for f in [cache.read_async(m["id"]) for m in view[:args.prefetch]]]
+                startup[name] = {"requests": client.requests, "received_bytes": client.received,
+                                 "ms": round((time.perf_counter() - started) * 1000, 1)}
+    finally:
+        cluster.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "func"},
+        "revision": git_revision(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "plain": plain,
+        "cached": cached,
+        "request_ratio": round(plain["requests"] / cached["requests"], 1),
+        "byte_ratio": round(plain["received_bytes"] / cached["received_bytes"], 1),
+        "startup": startup,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mail cluster benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("cluster", help="end-to-end load against a local DNS + N mail servers")
+    p.add_argument("--servers", type=int, default=2)
+    p.add_argument("--clients", type=int, default=16)
+    p.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    p.add_argument("--mix", type=parse_mix, default=parse_mix("list=40,read=30,send=20,delete=10"),
+                   help="op weights, e.g. list=40,read=30,send=20,delete=10")
+    p.add_argument("--remote-ratio", type=float, default=0.5, help="share of SENDs addressed to another server")
+    p.add_argument("--body-size", type=int, default=512)
+    p.add_argument("--compress", action="store_true", help="clients negotiate zlib at LOGIN")
+    p.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    p.add_argument("--workers", type=int, default=1, help="processes per mail server (server.py --workers)")
+    p.add_argument("--storage", choices=("memory", "log"), default="memory")
+    p.add_argument("--fsync", default="always")
+    p.add_argument("--server-arg", action="append", default=[], help="extra argument passed to every server.py")
+    p.add_argument("--poll", type=float, default=0.01, help="mailbox watcher poll interval (delivery resolution)")
+    p.add_argument("--drain", type=float, default=10.0, help="seconds to wait for in-flight deliveries")
+    p.add_argument("--log-dir", help="keep server logs here")
+    p.add_argument("--out", help="write the JSON result here (default: stdout)")
+    p.set_defaults(func=cmd_cluster)
+
+    p = sub.add_parser("serde", help="mail encode/decode cost, JSON vs binary records")
+    p.add_argument("--count", type=int, default=1000, help="mails per batch")
+    p.add_argument("--body-size", type=int, default=512)
+    p.add_argument("--repeat", type=int, default=20, help="timed runs, best one is reported")
+    p.add_argument("--out", help="write the JSON result here (default: stdout)")
+    p.set_defaults(func=cmd_serde)
+
+    p = sub.add_parser("memory", help="bytes held per stored mail, by in-memory layout")
+    p.add_argument("--count", type=int, default=1_000_000)
+    p.add_argument("--body-size", type=int, default=200)
+    p.add_argument("--users", type=int, default=100, help="mailboxes the mail is spread over")
+    p.add_argument("--layout", action="append", choices=tuple(LAYOUTS), help="repeatable (default: all)")
+    p.add_argument("--out", help="write the JSON result here (default: stdout)")
+    p.set_defaults(func=cmd_memory)
+
+    p = sub.add_parser("ids", help="mail id generation rate and uniqueness")
+    p.add_argument("--count", type=int, default=2_000_000)
+    p.add_argument("--threads", type=int, default=4)
+    p.add_argument("--seq-start", type=int, help="first sequence value (default: half the run before the wrap)")
+    p.add_argument("--out", help="write the JSON result here (default: stdout)")
+    p.set_defaults(func=cmd_ids)
+
+    p = sub.add_parser("pipeline", help="READ a page of mail lockstep vs pipelined over an added RTT")
+    p.add_argument("--count", type=int, default=50, help="mails to read")
+    p.add_argument("--rtt", type=float, default=50.0, help="round trip added by a local proxy, in ms")
+    p.add_argument("--body-size", type=int, default=2048)
+    p.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    p.add_argument("--log-dir", help="keep server logs here")
+    p.add_argument("--out", help="write the JSON result here (default: stdout)")
+    p.set_defaults(func=cmd_pipeline)
+
+    p = sub.add_parser("cache", help="requests a GUI session makes with and without the client mail cache")
+    p.add_argument("--mails", type=int, default=500, help="mails in the mailbox at the start")
+    p.add_argument("--actions", type=int, default=300, help="GUI actions in the session")
+    p.add_argument("--mix", type=parse_mix, default=parse_mix("list=20,read=60,send=10,delete=10"),
+                   help="action weights, e.g. list=20,read=60,send=10,delete=10")
+    p.add_argument("--hot", type=int, default=20, help="reads and deletes pick among the first N mails listed")
+    p.add_argument("--prefetch", type=int, default=50, help="bodies prefetched per inbox view, as the GUIs do")
+    p.add_argument("--self-send", type=float, default=0.2, help="share of sends addressed to the user itself")
+    p.add_argument("--body-size", type=int, default=2048)
+    p.add_argument("--max-bytes", type=int, default=16 * 1024 * 1024, help="cache body budget")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    p.add_argument("--log-dir", help="keep server logs here")
+    p.add_argument("--out", help="write the JSON result here (default: stdout)")
+    p.set_defaults(func=cmd_cache)
+
+    args = parser.parse_args()
+    result = args.func(args)
+    text = json.dumps(result, indent=2)
+    if getattr(args, "out", None):
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
-import socket
 import json
 import logging
 import sys
 
-DNS_HOST, DNS_PORT = "127.0.0.1", 4000
+from dns_client import DNSClient
+from mail_client import MailClient
+
+PAGE_SIZE = 50
 
 logging.basicConfig(
     level=logging.INFO,
@@ -13,52 +15,47 @@ logging.basicConfig(
 log = logging.getLogger("client")
 
 
-def dns_list() -> dict:
-    with socket.create_connection((DNS_HOST, DNS_PORT)) as s:
-        s.sendall(b'{"type": "LIST"}')
-        return json.loads(s.recv(4096).decode())["servers"]
-
-
-def dns_query(name: str) -> dict:
-    with socket.create_connection((DNS_HOST, DNS_PORT)) as s:
-        payload = {"type": "QUERY", "server": name}
-        s.sendall(json.dumps(payload).encode())
-        return json.loads(s.recv(1024).decode())
-
-
 class Client:
     def __init__(self, ip: str, port: int):
-        self.sock = socket.create_connection((ip, port))
+        self.conn = MailClient((ip, port))
         log.info(f"Connected to server at {ip}:{port}")
 
     def cmd(self, line: str) -> str:
-        self.sock.sendall(line.encode())
-        return self.sock.recv(4096).decode()
+        return self.conn.request(line.encode()).decode()
 
     def run(self):
         try:
             uid = input("ID: ")
             pw = input("PW: ")
-            if self.cmd(f"LOGIN::{uid}::{pw}") != "OK":
+            if not self.conn.login(uid, pw):
                 print("Login failed.")
                 return
 
             while True:
-                print("\n1 List  2 Read  3 Delete  4 Send  5 Quit")
+                print("\n1 List  2 Read  3 Delete  4 Send  5 Quit  6 Stats  7 Search")
                 choice = input("> ").strip()
 
                 if choice == "1":
-                    response = self.cmd("LIST")
-                    try:
-                        mails = json.loads(response)
-                        for m in mails:
+                    cursor = ""
+                    while cursor is not None:
+                        response = self.cmd(f"LIST::{PAGE_SIZE}::{cursor}")
+                        try:
+                            page = json.loads(response)
+                        except json.JSONDecodeError:
+                            print("Invalid LIST response:", response)
+                            break
+                        for m in page["mails"]:
                             print(f"- [{m['id']}] From: {m['sender']} | Subj: {m['subject']} | Date: {m['date']}")
-                    except json.JSONDecodeError:
-                        print("Invalid LIST response:", response)
+                        cursor = page["next"]
 
                 elif choice == "2":
                     mid = input("Mail ID: ")
-                    print(self.cmd(f"READ::{mid}"))
+                    mail = self.conn.read(mid)
+                    if mail:
+                        print(f"From: {mail['sender']}\nTo: {mail['receiver']}\nSubject: {mail['subject']}"
+                              f"\nDate: {mail['date']}\n\n{mail['body']}")
+                    else:
+                        print("Mail not found.")
 
                 elif choice == "3":
                     mid = input("Mail ID: ")
@@ -74,6 +71,22 @@ class Client:
                     print(self.cmd("LOGOUT"))
                     break
 
+                elif choice == "6":
+                    print(json.dumps(json.loads(self.cmd("STATS")), indent=2))
+
+                elif choice == "7":
+                    query = input("Search (from: subject: body: after: before:)> ")
+                    cursor = ""
+                    while cursor is not None:
+                        response = self.cmd(f"SEARCH::{query}::{PAGE_SIZE}::{cursor}")
+                        if response == "INVALID_ARGUMENTS":
+                            print("Invalid search.")
+                            break
+                        page = json.loads(response)
+                        for m in page["mails"]:
+                            print(f"- [{m['id']}] From: {m['sender']} | Subj: {m['subject']} | Date: {m['date']}")
+                        cursor = page["next"]
+
                 else:
                     print("Invalid option.")
 
@@ -82,12 +95,17 @@ class Client:
         except Exception as e:
             log.exception(f"Unexpected error: {e}")
         finally:
-            self.sock.close()
+            self.conn.close()
             log.info("Connection closed")
 
 
 def main():
-    servers = dns_list()
+    with DNSClient() as dns:
+        select_server(dns)
+
+
+def select_server(dns: DNSClient):
+    servers = dns.list()
     if not servers:
         print("No mail server registered.")
         return
@@ -95,7 +113,8 @@ def main():
     print("\nAvailable Mail Servers:")
     for idx, name in enumerate(servers, 1):
         info = servers[name]
-        print(f"{idx}. {name} ({info['ip']}:{info['port']})")
+        note = " [OVERLOAD]" if info.get("status") == "OVERLOAD" else ""
+        print(f"{idx}. {name} ({info['ip']}:{info['port']}){note}")
 
     try:
         sel = int(input("Select server> ")) - 1
@@ -104,10 +123,12 @@ def main():
         print("Invalid selection.")
         return
 
-    info = dns_query(name)
-    if info.get("status") != "OK":
+    info = dns.query(name)
+    if info.get("status") not in ("OK", "OVERLOAD"):
         print(f"Server {name} not found.")
         return
+    if info["status"] == "OVERLOAD":
+        print(f"Server {name} is overloaded, responses may be slow.")
 
     client = Client(info["ip"], info["port"])
     client.run()
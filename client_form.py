@@ -1,22 +1,13 @@
 import tkinter as tk
 from tkinter import messagebox, scrolledtext
-import socket
 import json
 
+from dns_client import DNSClient
+from mail_cache import MailCache, cache_path
+from mail_client import MailClient
 
-DNS_HOST, DNS_PORT = "127.0.0.1", 4000
-
-
-def dns_list():
-    with socket.create_connection((DNS_HOST, DNS_PORT)) as s:
-        s.sendall(b'{"type":"LIST"}')
-        return json.loads(s.recv(4096).decode())["servers"]
-
-
-def dns_query(name):
-    with socket.create_connection((DNS_HOST, DNS_PORT)) as s:
-        s.sendall(json.dumps({"type": "QUERY", "server": name}).encode())
-        return json.loads(s.recv(1024).decode())
+PREFETCH = 50
+SYNC_INTERVAL_MS = 30_000
 
 
 class MailClientApp(tk.Tk):
@@ -25,14 +16,18 @@ class MailClientApp(tk.Tk):
         self.title("Potato Mail")
         self.geometry("700x500")
 
-        self.sock = None
+        self.dns = DNSClient()
+        self.conn = None
         self.username = None
         self.mailbox = []
+        self.cache = None
+        self.sync_job = None
 
         self.frames = {}
 
         self.build_frames()
         self.show_frame("ServerSelect")
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def build_frames(self):
         self.frames["ServerSelect"] = self.build_server_select_frame()
@@ -57,7 +52,7 @@ class MailClientApp(tk.Tk):
         return frame
 
     def refresh_server_list(self):
-        self.servers = dns_list()
+        self.servers = self.dns.sync()
         self.server_listbox.delete(0, tk.END)
         for i, name in enumerate(self.servers):
             info = self.servers[name]
@@ -67,8 +62,8 @@ class MailClientApp(tk.Tk):
         try:
             idx = self.server_listbox.curselection()[0]
             self.server_name = list(self.servers.keys())[idx]
-            info = dns_query(self.server_name)
-            self.sock = socket.create_connection((info["ip"], info["port"]))
+            info = self.dns.query(self.server_name)
+            self.conn = MailClient((info["ip"], info["port"]))
             self.show_frame("Login")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to connect: {e}")
@@ -96,13 +91,13 @@ class MailClientApp(tk.Tk):
         uid = self.entry_id.get()
         pw = self.entry_pw.get()
         try:
-            self.sock.sendall(f"LOGIN::{uid}::{pw}".encode())
-            res = self.sock.recv(1024).decode()
-            if res == "OK":
+            if self.conn.login(uid, pw):
                 self.username = uid
+                self.cache = MailCache(self.conn, cache_path(self.server_name, uid))
                 self.label_login_info.config(text="Login Success", fg="green")
                 self.show_frame("Main")
                 self.load_mail_list()
+                self.sync_job = self.after(SYNC_INTERVAL_MS, self.auto_sync)
             else:
                 self.label_login_info.config(text="Login Failed", fg="red")
         except Exception as e:
@@ -115,6 +110,9 @@ class MailClientApp(tk.Tk):
         tk.Frame(frame).pack()
         btn_frame = tk.Frame(frame)
         tk.Button(btn_frame, text="Inbox", command=self.load_mail_list).pack(side="left", padx=5)
+        self.entry_search = tk.Entry(btn_frame, width=30)
+        self.entry_search.pack(side="left", padx=5)
+        tk.Button(btn_frame, text="Search", command=self.search_mail).pack(side="left", padx=5)
         tk.Button(btn_frame, text="Logout", command=self.logout).pack(side="left", padx=5)
         btn_frame.pack(pady=10)
 
@@ -148,26 +146,52 @@ class MailClientApp(tk.Tk):
 
     def load_mail_list(self):
         try:
-            self.sock.sendall(b"LIST")
-            data = self.sock.recv(4096).decode()
-            self.mailbox = json.loads(data)
-            self.mail_listbox.delete(0, tk.END)
-            for i, m in enumerate(self.mailbox):
-                self.mail_listbox.insert(i, f"[{m['id']}] {m['date']} - {m['subject']} from {m['sender']}")
+            self.show_mail_list(self.cache.sync())
         except Exception as e:
             messagebox.showerror("Inbox Error", str(e))
 
+    def auto_sync(self):
+        # Picks up new mail between explicit refreshes; the list is only redrawn if it changed.
+        self.sync_job = self.after(SYNC_INTERVAL_MS, self.auto_sync)
+        if self.entry_search.get().strip():
+            return
+        version = self.cache.version
+        try:
+            mails = self.cache.sync()
+        except Exception:
+            return
+        if self.cache.version != version:
+            self.show_mail_list(mails)
+
+    def search_mail(self):
+        query = self.entry_search.get().strip()
+        if not query:
+            self.load_mail_list()
+            return
+        try:
+            data = self.conn.request(f"SEARCH::{query}::200".encode()).decode()
+            if data == "INVALID_ARGUMENTS":
+                messagebox.showwarning("Search", "Invalid search query.")
+                return
+            self.show_mail_list(json.loads(data)["mails"])
+        except Exception as e:
+            messagebox.showerror("Search Error", str(e))
+
+    def show_mail_list(self, mails):
+        self.mailbox = mails
+        self.mail_listbox.delete(0, tk.END)
+        for i, m in enumerate(self.mailbox):
+            self.mail_listbox.insert(i, f"[{m['id']}] {m['date']} - {m['subject']} from {m['sender']}")
+        self.cache.prefetch(m["id"] for m in self.mailbox[:PREFETCH])
+
     def read_selected_mail(self, event):
         if not self.mail_listbox.curselection():
             return
         idx = self.mail_listbox.curselection()[0]
         mid = self.mailbox[idx]["id"]
         try:
-            self.sock.sendall(f"READ::{mid}".encode())
-            res = self.sock.recv(4096).decode()
-            if res.startswith("READ_OK::"):
-                mail_json = res.split("::", 1)[1]
-                mail = eval(mail_json)  # 안전하게 하려면 json.loads() 쓰되, 서버 쪽 JSON으로 바꾸기
+            mail = self.cache.read(mid)
+            if mail:
                 self.text_read.delete(1.0, tk.END)
                 self.text_read.insert(tk.END, f"From: {mail['sender']}\nTo: {mail['receiver']}\nSubject: {mail['subject']}\n\n{mail['body']}")
             else:
@@ -181,14 +205,17 @@ class MailClientApp(tk.Tk):
         subj = self.entry_subject.get()
         body = self.text_body.get("1.0", tk.END).strip()
         try:
-            self.sock.sendall(f"SEND::{to}::{subj}::{body}".encode())
-            res = self.sock.recv(1024).decode()
+            res = self.conn.request(f"SEND::{to}::{subj}::{body}".encode()).decode()
             if res in ("SEND_OK", "SEND_QUEUED"):
                 messagebox.showinfo("Send", "Mail sent successfully.")
                 self.entry_to.delete(0, tk.END)
                 self.entry_subject.delete(0, tk.END)
                 self.text_body.delete("1.0", tk.END)
-                self.load_mail_list()
+                # Only mail to ourselves changes the inbox; anything else shows up on the next sync.
+                if to.strip() == f"{self.username}@{self.server_name}":
+                    self.load_mail_list()
+            elif res.startswith("SEND_BUSY::"):
+                messagebox.showwarning("Server Busy", f"Try again in {res.split('::')[1]}s.")
             else:
                 messagebox.showerror("Send Failed", res)
         except Exception as e:
@@ -200,27 +227,35 @@ class MailClientApp(tk.Tk):
         idx = self.mail_listbox.curselection()[0]
         mid = self.mailbox[idx]["id"]
         try:
-            self.sock.sendall(f"DELETE::{mid}".encode())
-            res = self.sock.recv(1024).decode()
-            if res == "DELETE_OK":
+            if self.cache.delete(mid):
                 messagebox.showinfo("Delete", "Mail deleted.")
-                self.load_mail_list()
+                self.show_mail_list(self.cache.view())
                 self.text_read.delete(1.0, tk.END)
             else:
-                messagebox.showerror("Delete Failed", res)
+                messagebox.showerror("Delete Failed", "Mail could not be deleted.")
         except Exception as e:
             messagebox.showerror("Delete Error", str(e))
 
     def logout(self):
+        if self.sync_job is not None:
+            self.after_cancel(self.sync_job)
+            self.sync_job = None
         try:
-            self.sock.sendall(b"LOGOUT")
-            self.sock.close()
+            self.cache.save()
+            self.conn.send(b"LOGOUT")
+            self.conn.close()
         except:
             pass
         self.username = None
-        self.sock = None
+        self.conn = None
+        self.cache = None
         self.show_frame("ServerSelect")
 
+    def on_close(self):
+        if self.cache is not None:
+            self.logout()
+        self.destroy()
+
 
 if __name__ == "__main__":
     app = MailClientApp()
@@ -1,8 +1,13 @@
 import customtkinter as ctk
-import socket, json
+import json
+
+from dns_client import DNSClient
+from mail_cache import MailCache, cache_path
+from mail_client import MailClient
 from tkinter import messagebox
 
-DNS_HOST, DNS_PORT = "127.0.0.1", 4000
+PREFETCH = 50
+SYNC_INTERVAL_MS = 30_000
 
 class PotatoMailApp(ctk.CTk):
     def __init__(self):
@@ -12,12 +17,16 @@ class PotatoMailApp(ctk.CTk):
         ctk.set_appearance_mode("dark")
         ctk.set_default_color_theme("blue")
 
+        self.dns = DNSClient()
         self.server_info = None
-        self.sock = None
+        self.conn = None
         self.username = None
         self.mailbox = []
+        self.cache = None
+        self.sync_job = None
 
         self.build_server_select_frame()
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def build_server_select_frame(self):
         self.clear_window()
@@ -36,10 +45,7 @@ class PotatoMailApp(ctk.CTk):
         for w in self.server_list_frame.winfo_children():
             w.destroy()
         try:
-            with socket.create_connection((DNS_HOST, DNS_PORT)) as s:
-                s.sendall(b'{"type":"LIST"}')
-                data = json.loads(s.recv(4096).decode())
-            servers = data.get("servers", {})
+            servers = self.dns.sync()
             if not servers:
                 ctk.CTkLabel(self.server_list_frame, text="(No servers found)", text_color="gray").pack(pady=20)
             for name, info in servers.items():
@@ -56,10 +62,8 @@ class PotatoMailApp(ctk.CTk):
 
     def select_server(self, name):
         try:
-            with socket.create_connection((DNS_HOST, DNS_PORT)) as s:
-                s.sendall(json.dumps({"type":"QUERY","server":name}).encode())
-                info = json.loads(s.recv(1024).decode())
-            self.server_info = {"ip":info["ip"], "port":info["port"]}
+            info = self.dns.query(name)
+            self.server_info = {"name":name, "ip":info["ip"], "port":info["port"]}
             self.build_login_frame()
         except Exception as e:
             messagebox.showerror("Error", f"Cannot query server: {e}")
@@ -82,12 +86,12 @@ class PotatoMailApp(ctk.CTk):
     def login(self):
         uid, pw = self.login_id.get(), self.login_pw.get()
         try:
-            self.sock = socket.create_connection((self.server_info["ip"], self.server_info["port"]))
-            self.sock.sendall(f"LOGIN::{uid}::{pw}".encode())
-            res = self.sock.recv(1024).decode()
-            if res == "OK":
+            self.conn = MailClient((self.server_info["ip"], self.server_info["port"]))
+            if self.conn.login(uid, pw):
                 self.username = uid
+                self.cache = MailCache(self.conn, cache_path(self.server_info["name"], uid))
                 self.build_main_frame()
+                self.sync_job = self.after(SYNC_INTERVAL_MS, self.auto_sync)
             else:
                 messagebox.showerror("Login Failed", "Invalid credentials. Please select server again.")
                 self.build_server_select_frame()
@@ -112,12 +116,15 @@ class PotatoMailApp(ctk.CTk):
 
         self.show_inbox()
 
-    def show_inbox(self):
+    def show_inbox(self, sync: bool = True):
         self.clear_body()
         left = ctk.CTkFrame(self.body)
         left.pack(side="left", fill="y", padx=(0,10))
 
         ctk.CTkLabel(left, text="Inbox", font=("Arial", 24, "bold")).pack(pady=(0,15))
+        self.search_entry = ctk.CTkEntry(left, placeholder_text="Search (from: subject: after:)", width=350)
+        self.search_entry.pack(pady=(0,10))
+        self.search_entry.bind("<Return>", lambda e: self.refresh_inbox())
         self.inbox_frame = ctk.CTkScrollableFrame(left, width=350, height=550)
         self.inbox_frame.pack()
 
@@ -131,17 +138,39 @@ class PotatoMailApp(ctk.CTk):
         self.read_body = ctk.CTkTextbox(right, width=650, height=480, corner_radius=8)
         self.read_body.pack(expand=True, fill="both")
 
-        self.refresh_inbox()
+        self.refresh_inbox(sync)
 
-    def refresh_inbox(self):
+    def auto_sync(self):
+        # Picks up new mail between explicit refreshes; the inbox is only redrawn if it changed.
+        self.sync_job = self.after(SYNC_INTERVAL_MS, self.auto_sync)
+        inbox = getattr(self, "inbox_frame", None)
+        if inbox is None or not inbox.winfo_exists() or self.search_entry.get().strip():
+            return
+        version = self.cache.version
+        try:
+            self.cache.sync()
+        except Exception:
+            return
+        if self.cache.version != version:
+            self.refresh_inbox(sync=False)
+
+    def refresh_inbox(self, sync: bool = True):
         for w in self.inbox_frame.winfo_children():
             w.destroy()
         try:
-            self.sock.sendall(b"LIST")
-            self.mailbox = json.loads(self.sock.recv(4096).decode())
+            query = self.search_entry.get().strip()
+            if query:
+                res = self.conn.request(f"SEARCH::{query}::200".encode())
+                if res == b"INVALID_ARGUMENTS":
+                    messagebox.showwarning("Search", "Invalid search query.")
+                    return
+                self.mailbox = json.loads(res)["mails"]
+            else:
+                self.mailbox = self.cache.sync() if sync else self.cache.view()
             if not self.mailbox:
                 ctk.CTkLabel(self.inbox_frame, text="(No mail)", text_color="gray").pack(pady=20)
                 return
+            self.cache.prefetch(m["id"] for m in self.mailbox[:PREFETCH])
             for m in self.mailbox:
                 btn = ctk.CTkButton(
                     self.inbox_frame,
@@ -156,10 +185,8 @@ class PotatoMailApp(ctk.CTk):
 
     def load_mail(self, mid):
         try:
-            self.sock.sendall(f"READ::{mid}".encode())
-            res = self.sock.recv(4096).decode()
-            if res.startswith("READ_OK::"):
-                m = json.loads(res.split("::",1)[1].replace("'", '"'))
+            m = self.cache.read(mid)
+            if m:
                 self.read_subject.configure(text=m["subject"])
                 self.read_meta.configure(text=f"From: {m['sender']}    Date: {m['date']}")
                 self.read_body.delete("1.0", "end")
@@ -200,11 +227,13 @@ class PotatoMailApp(ctk.CTk):
             messagebox.showwarning("Input Error", "To and Subject are required.")
             return
         try:
-            self.sock.sendall(f"SEND::{to}::{subj}::{body}".encode())
-            res = self.sock.recv(1024).decode()
+            res = self.conn.request(f"SEND::{to}::{subj}::{body}".encode()).decode()
             if res in ("SEND_OK", "SEND_QUEUED"):
                 messagebox.showinfo("Success", "Mail sent successfully.")
-                self.show_inbox()
+                # Only mail to ourselves changes the inbox; anything else shows up on the next sync.
+                self.show_inbox(sync=to == f"{self.username}@{self.server_info['name']}")
+            elif res.startswith("SEND_BUSY::"):
+                messagebox.showwarning("Server Busy", f"Try again in {res.split('::')[1]}s.")
             else:
                 messagebox.showerror("Send Failed", res)
         except Exception as e:
@@ -213,24 +242,32 @@ class PotatoMailApp(ctk.CTk):
     def delete_mail(self, mid):
         if messagebox.askyesno("Confirm Delete", "Are you sure you want to delete this mail?"):
             try:
-                self.sock.sendall(f"DELETE::{mid}".encode())
-                res = self.sock.recv(1024).decode()
-                if res == "DELETE_OK":
+                if self.cache.delete(mid):
                     messagebox.showinfo("Success", "Mail deleted.")
-                    self.show_inbox()
+                    self.show_inbox(sync=False)
                 else:
-                    messagebox.showerror("Delete Failed", res)
+                    messagebox.showerror("Delete Failed", "Mail could not be deleted.")
             except Exception as e:
                 messagebox.showerror("Delete Error", str(e))
 
     def logout(self):
+        if self.sync_job is not None:
+            self.after_cancel(self.sync_job)
+            self.sync_job = None
         try:
-            self.sock.sendall(b"LOGOUT")
-            self.sock.close()
+            self.cache.save()
+            self.conn.send(b"LOGOUT")
+            self.conn.close()
         except:
             pass
+        self.cache = None
         self.build_server_select_frame()
 
+    def on_close(self):
+        if self.cache is not None:
+            self.logout()
+        self.destroy()
+
     def clear_window(self):
         for w in self.winfo_children():
             w.destroy()
@@ -1,16 +1,45 @@
+import argparse
 import socket
+import heapq
 import json
 import logging
+import random
 import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from queue import Empty, Full, Queue
 from typing import Dict, Any
 
+import protocol
+from metrics import Metrics
+
+REQUEST_TYPES = ("REGISTER", "QUERY", "QUERY_MANY", "LIST", "WATCH", "STATS")
+
+
+class Sweep:
+    def __init__(self, total: int):
+        self.total = total
+        self.remaining = total
+        self.started = time.monotonic()
+        self.duration = 0.0
+        self.lock = threading.Lock()
+
+    def done(self) -> bool:
+        with self.lock:
+            self.remaining -= 1
+            if self.remaining:
+                return False
+        self.duration = time.monotonic() - self.started
+        return True
+
 
 class DNSRegistryServer:
-    def __init__(self, host="0.0.0.0", port=4000):
+    def __init__(self, host="0.0.0.0", port=4000, metrics_port=None):
         self.host = host
         self.port = port
+        self.metrics_port = metrics_port
         self.registry: Dict[str, Dict[str, Any]] = {}
         self.lock = threading.Lock()
         self.stop_event = threading.Event()
@@ -19,6 +48,33 @@ class DNSRegistryServer:
         self.PING_INTERVAL = 10
         self.PING_TIMEOUT = 3
         self.PING_MAX_STRIKES = 3
+        self.PING_JITTER = 0.1
+        self.PROBE_BUDGET = 32
+
+        # Servers report load in their PONG; a deep queue or a slow p99 marks them OVERLOAD
+        # until they drop back below OVERLOAD_RECOVER of it. Open sessions alone do not: a
+        # server holding many idle clients can still take mail.
+        self.OVERLOAD_QUEUE = 1000
+        self.OVERLOAD_P99_MS = 250
+        self.OVERLOAD_RECOVER = 0.8
+
+        self.checks: Dict[str, tuple[float, float]] = {}
+        self.next_check: Dict[str, float] = {}
+        self.schedule: list[tuple[float, str]] = []
+        self.checked_at: Dict[str, float] = {}
+        self.last_sweep: Dict[str, Any] = {}
+
+        # Every registration, status transition and removal bumps the version. LIST since N
+        # is answered from the change history; WATCH subscribers get each change pushed.
+        self.CHANGE_HISTORY = 4096
+        self.WATCH_QUEUE = 1024
+        self.WATCH_HEARTBEAT = 10
+        self.WATCH_SEND_TIMEOUT = 30
+        self.version = 0
+        self.changes: deque[tuple[int, str]] = deque()
+        self.changes_floor = 0
+        self.watchers: list[Queue] = []
+        self.snapshot: tuple[int, bytes] = (-1, b"")
 
         logging.basicConfig(
             level=logging.INFO,
@@ -27,6 +83,17 @@ class DNSRegistryServer:
         )
         self.log = logging.getLogger("dns")
 
+        self.metrics = Metrics("dns")
+        for status in ("OK", "OVERLOAD", "FAIL"):
+            self.metrics.gauge(f"servers_{status.lower()}", lambda status=status: self.count_status(status))
+        self.metrics.gauge("watchers", lambda: len(self.watchers))
+        self.metrics.gauge("registry_version", lambda: self.version)
+        self.metrics.gauge("oldest_status_seconds", lambda: self.last_sweep.get("oldest_status", 0.0))
+
+    def count_status(self, status: str) -> int:
+        with self.lock:
+            return sum(1 for info in self.registry.values() if info["status"] == status)
+
     def start(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.settimeout(1.0)
@@ -35,6 +102,8 @@ class DNSRegistryServer:
         self.log.info(f"DNS listening on {self.host}:{self.port}")
 
         threading.Thread(target=self.ping_loop, daemon=True).start()
+        if self.metrics_port:
+            self.metrics.serve(self.metrics_port)
 
         while not self.stop_event.is_set():
             try:
@@ -48,61 +117,213 @@ class DNSRegistryServer:
                 self.sock.close()
                 break
 
+    def changed(self, name: str):
+        # Caller holds self.lock.
+        self.version += 1
+        self.changes.append((self.version, name))
+        if len(self.changes) > self.CHANGE_HISTORY:
+            self.changes_floor = self.changes.popleft()[0]
+        info = self.registry.get(name)
+        event = {"version": self.version, "server": name, "info": dict(info) if info else None}
+        for q in self.watchers[:]:
+            try:
+                q.put_nowait(event)
+            except Full:
+                # Never block under the lock: the backlog is thrown away to make room for the
+                # drop marker. Only this method puts, so the put after draining cannot fail.
+                self.watchers.remove(q)
+                while True:
+                    try:
+                        q.get_nowait()
+                    except Empty:
+                        break
+                q.put_nowait(None)
+
+    def list_all(self) -> bytes:
+        with self.lock:
+            if self.snapshot[0] != self.version:
+                servers = {name: info for name, info in self.registry.items() if info.get("status") != "FAIL"}
+                self.snapshot = (self.version, json.dumps({"version": self.version, "servers": servers}).encode())
+            return self.snapshot[1]
+
+    def list_since(self, since: int) -> dict:
+        # Caller holds self.lock.
+        if since < self.changes_floor or since > self.version:
+            servers = {name: info for name, info in self.registry.items() if info.get("status") != "FAIL"}
+            return {"version": self.version, "reset": True, "servers": servers}
+        servers, removed = {}, []
+        for version, name in reversed(self.changes):
+            if version <= since:
+                break
+            if name in servers or name in removed:
+                continue
+            info = self.registry.get(name)
+            if info is not None and info.get("status") != "FAIL":
+                servers[name] = info
+            else:
+                removed.append(name)
+        return {"version": self.version, "servers": servers, "removed": removed}
+
+    def schedule_check(self, name: str, first: bool = False):
+        interval = self.checks.get(name, (self.PING_INTERVAL, self.PING_TIMEOUT))[0]
+        if first:
+            delay = interval * random.random()
+        else:
+            delay = interval * random.uniform(1 - self.PING_JITTER, 1 + self.PING_JITTER)
+        due = time.monotonic() + delay
+        self.next_check[name] = due
+        heapq.heappush(self.schedule, (due, name))
+
     def ping_loop(self):
+        # Each server has its own jittered schedule; at most PROBE_BUDGET probes run at once.
+        pool = ThreadPoolExecutor(max_workers=self.PROBE_BUDGET, thread_name_prefix="probe")
         while not self.stop_event.is_set():
-            time.sleep(self.PING_INTERVAL)
+            now = time.monotonic()
+            due = []
             with self.lock:
-                names = list(self.registry.keys())
+                while self.schedule and self.schedule[0][0] <= now:
+                    at, name = heapq.heappop(self.schedule)
+                    if name in self.registry and self.next_check.get(name) == at:
+                        due.append(name)
+                wait = self.schedule[0][0] - now if self.schedule else 1.0
 
-            for name in names:
-                with self.lock:
-                    info = self.registry.get(name)
-                    if not info:
-                        continue
-                    ip, port = info["ip"], info["port"]
-                    prev_status = info["status"]
+            if due:
+                sweep = Sweep(len(due))
+                for name in due:
+                    pool.submit(self.probe, name, sweep)
+            self.stop_event.wait(min(max(wait, 0.01), 1.0))
+        pool.shutdown(wait=False)
+
+    def probe(self, name: str, sweep: "Sweep"):
+        try:
+            with self.lock:
+                info = self.registry.get(name)
+                if not info:
+                    return
+                ip, port = info["ip"], info["port"]
+                prev_status = info["status"]
+                timeout = self.checks.get(name, (self.PING_INTERVAL, self.PING_TIMEOUT))[1]
 
-                ok = self.ping(ip, port)
-                new_status = "OK" if ok else "FAIL"
+            started = time.perf_counter()
+            load = self.ping(ip, port, timeout)
+            self.metrics.observe("probe_seconds", time.perf_counter() - started)
+            if load is None:
+                new_status = "FAIL"
+            elif self.overloaded(load, prev_status == "OVERLOAD"):
+                new_status = "OVERLOAD"
+            else:
+                new_status = "OK"
 
+            self.metrics.inc("probes_total", result=new_status)
+            with self.lock:
+                info = self.registry.get(name)
+                if not info:
+                    return
+                info["status"] = new_status
+                info["last_ping"] = datetime.now(timezone.utc).isoformat()
+                info["strikes"] = 0 if load is not None else info.get("strikes", 0) + 1
+                if load:
+                    info["load"] = load
+                self.checked_at[name] = time.monotonic()
+
+                if new_status != prev_status:
+                    self.log.warning(f"Status Changed: <{name}> {prev_status} → {new_status}")
+                    self.changed(name)
+
+                if self.PING_MAX_STRIKES and info["strikes"] >= self.PING_MAX_STRIKES:
+                    self.log.error(f"Removed: <{name}> after {info['strikes']} failed pings")
+                    self.registry.pop(name)
+                    self.checks.pop(name, None)
+                    self.next_check.pop(name, None)
+                    self.checked_at.pop(name, None)
+                    self.changed(name)
+                else:
+                    self.schedule_check(name)
+        finally:
+            if sweep.done():
+                now = time.monotonic()
                 with self.lock:
-                    info = self.registry.get(name)
-                    if not info:
-                        continue
-                    info["status"] = new_status
-                    info["last_ping"] = datetime.now(timezone.utc).isoformat()
-                    info["strikes"] = 0 if new_status == "OK" else info.get("strikes", 0) + 1
+                    oldest = max((now - at for at in self.checked_at.values()), default=0.0)
+                self.last_sweep = {"servers": sweep.total, "duration": round(sweep.duration, 3),
+                                   "oldest_status": round(oldest, 3)}
+                self.metrics.observe("sweep_seconds", sweep.duration)
+                self.log.debug(f"Sweep of {sweep.total} server(s) took {sweep.duration:.3f}s, "
+                               f"oldest status {oldest:.1f}s")
 
-                    if new_status != prev_status:
-                        self.log.warning(f"Status Changed: <{name}> {prev_status} → {new_status}")
+    def overloaded(self, load: dict, already: bool) -> bool:
+        scale = self.OVERLOAD_RECOVER if already else 1.0
+        return (
+            load.get("inbox", 0) + load.get("outbox", 0) >= self.OVERLOAD_QUEUE * scale
+            or load.get("p99_ms", 0) >= self.OVERLOAD_P99_MS * scale
+            or bool(load.get("busy"))
+        )
 
-                    if self.PING_MAX_STRIKES and info["strikes"] >= self.PING_MAX_STRIKES:
-                        self.log.error(f"Removed: <{name}> after {info['strikes']} failed pings")
-                        self.registry.pop(name)
+    def rank(self, names) -> list[str]:
+        # Caller holds self.lock. Least loaded first; OVERLOAD after every OK server.
+        def key(name):
+            info = self.registry[name]
+            load = info.get("load", {})
+            return (info["status"] != "OK", load.get("p99_ms", 0),
+                    load.get("inbox", 0) + load.get("outbox", 0), load.get("sessions", 0))
+        return sorted((name for name in names if name in self.registry), key=key)
 
-    def ping(self, ip: str, port: int) -> bool:
+    def ping(self, ip: str, port: int, timeout: float | None = None) -> dict | None:
+        # Returns the reported load ({} from servers that only answer a bare PONG), None if down.
+        timeout = timeout or self.PING_TIMEOUT
         try:
-            with socket.create_connection((ip, port), timeout=self.PING_TIMEOUT) as s:
-                s.sendall(b"PING")
-                s.settimeout(self.PING_TIMEOUT)
-                return s.recv(4) == b"PONG"
+            with protocol.Connection.open((ip, port), timeout=timeout) as c:
+                res = c.request(b"PING::LOAD")
         except Exception:
-            return False
+            return None
+        if not res.startswith(b"PONG"):
+            return None
+        try:
+            return json.loads(res[6:]) if res.startswith(b"PONG::") else {}
+        except ValueError:
+            return {}
+
+    def watch(self, conn: socket.socket, since: int | None):
+        q: Queue = Queue(self.WATCH_QUEUE)
+        # A subscriber that stops reading fails the send instead of pinning this thread.
+        conn.settimeout(self.WATCH_SEND_TIMEOUT)
+        with self.lock:
+            self.watchers.append(q)
+            payload = self.list_since(-1 if since is None else int(since))
+        try:
+            protocol.send_frame(conn, json.dumps(payload).encode())
+            while not self.stop_event.is_set():
+                try:
+                    event = q.get(timeout=self.WATCH_HEARTBEAT)
+                except Empty:
+                    event = {"version": self.version}
+                if event is None:
+                    self.log.warning("Dropped slow WATCH subscriber")
+                    return
+                protocol.send_frame(conn, json.dumps(event).encode())
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                if q in self.watchers:
+                    self.watchers.remove(q)
 
     def handle_connection(self, conn: socket.socket, addr):
+        reader = protocol.FrameReader(conn)
+        framed = False
         try:
             while not self.stop_event.is_set():
-                raw = conn.recv(4096)
-                if not raw:
+                raw, framed = reader.read_message()
+                if raw is None:
                     return
 
                 try:
-                    req = json.loads(raw.decode())
+                    req = json.loads(raw)
                 except json.JSONDecodeError:
-                    conn.sendall(b'"INVALID_JSON"')
+                    protocol.reply(conn, b'"INVALID_JSON"', framed)
                     return
 
                 typ = req.get("type", "").upper()
+                started = time.perf_counter()
 
                 if typ == "REGISTER":
                     name = req["server"]
@@ -115,32 +336,65 @@ class DNSRegistryServer:
                             "last_ping": None,
                             "strikes": 0,
                         }
-                    conn.sendall(b'"REGISTERED"')
+                        self.checks[name] = (
+                            float(req.get("check_interval", self.PING_INTERVAL)),
+                            float(req.get("check_timeout", self.PING_TIMEOUT)),
+                        )
+                        self.schedule_check(name, first=True)
+                        self.changed(name)
+                    protocol.reply(conn, b'"REGISTERED"', framed)
                     self.log.info(f"Registered <{name}> → {req['ip']}:{req['port']}")
 
                 elif typ == "QUERY":
                     with self.lock:
                         res = self.registry.get(req["server"], {"status": "FAIL"})
-                    conn.sendall(json.dumps(res).encode())
+                    protocol.reply(conn, json.dumps(res).encode(), framed)
 
-                elif typ == "LIST":
+                elif typ == "QUERY_MANY":
                     with self.lock:
-                        payload = {
-                            "servers": {
-                                name: info
-                                for name, info in self.registry.items()
-                                if info.get("status") == "OK"
-                            }
-                        }
-                    conn.sendall(json.dumps(payload).encode())
+                        payload = {"servers": {name: self.registry.get(name, {"status": "FAIL"})
+                                               for name in req["servers"]}}
+                        if req.get("rank"):
+                            payload["ranked"] = self.rank(req["servers"])
+                    protocol.reply(conn, json.dumps(payload).encode(), framed)
+
+                elif typ == "LIST":
+                    if req.get("rank"):
+                        with self.lock:
+                            ranked = [name for name in self.rank(self.registry)
+                                      if self.registry[name]["status"] != "FAIL"]
+                            payload = {"version": self.version, "ranked": ranked,
+                                       "servers": {name: self.registry[name] for name in ranked}}
+                        protocol.reply(conn, json.dumps(payload).encode(), framed)
+                    elif req.get("since") is None:
+                        protocol.reply(conn, self.list_all(), framed)
+                    else:
+                        with self.lock:
+                            payload = self.list_since(int(req["since"]))
+                        protocol.reply(conn, json.dumps(payload).encode(), framed)
+
+                elif typ == "WATCH":
+                    if not framed:
+                        protocol.reply(conn, b'"FRAMED_ONLY"', framed)
+                        return
+                    self.watch(conn, req.get("since"))
+                    return
+
+                elif typ == "STATS":
+                    stats = {**self.metrics.snapshot(), "last_sweep": self.last_sweep}
+                    protocol.reply(conn, json.dumps(stats).encode(), framed)
 
                 else:
-                    conn.sendall(b'"INVALID_REQUEST"')
+                    protocol.reply(conn, b'"INVALID_REQUEST"', framed)
+
+                label = typ if typ in REQUEST_TYPES else "OTHER"
+                self.metrics.inc("requests_total", type=label)
+                self.metrics.observe("request_seconds", time.perf_counter() - started, type=label)
 
         except Exception as e:
             self.log.exception(f"Handler error: {e}")
             try:
-                conn.sendall(b'"ERROR"')
+                protocol.reply(conn, b'"ERROR"', framed)
             except Exception:
                 pass
         finally:
@@ -148,4 +402,8 @@ class DNSRegistryServer:
 
 
 if __name__ == "__main__":
-    DNSRegistryServer().start()
+    parser = argparse.ArgumentParser(description="DNS registry")
+    parser.add_argument("--port", type=int, default=4000)
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus text metrics on this port")
+    args = parser.parse_args()
+    DNSRegistryServer(port=args.port, metrics_port=args.metrics_port).start()
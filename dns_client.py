@@ -0,0 +1,93 @@
+import json
+import threading
+from typing import Any, Iterator
+
+import protocol
+
+DNS_HOST, DNS_PORT = "127.0.0.1", 4000
+WATCH_TIMEOUT = 30.0  # registry heartbeats every 10s
+
+
+class DNSClient:
+    # One keep-alive framed connection to the registry, shared by all callers. A request
+    # on a connection the registry has dropped is retried once on a fresh one.
+    def __init__(self, host: str = DNS_HOST, port: int = DNS_PORT, timeout: float | None = 10.0):
+        self.address = (host, port)
+        self.timeout = timeout
+        self._conn: protocol.Connection | None = None
+        self._lock = threading.Lock()
+        self.servers: dict[str, dict] = {}
+        self.version: int | None = None
+
+    def request(self, payload: dict) -> Any:
+        data = json.dumps(payload).encode()
+        with self._lock:
+            for attempt in range(2):
+                reused = self._conn is not None
+                if not reused:
+                    self._conn = protocol.Connection.open(self.address, timeout=self.timeout)
+                try:
+                    return json.loads(self._conn.request(data))
+                except (OSError, ConnectionError):
+                    self._conn.close()
+                    self._conn = None
+                    if not reused or attempt:
+                        raise
+
+    def register(self, server: str, ip: str, port: int, **checks) -> str:
+        return self.request({"type": "REGISTER", "server": server, "ip": ip, "port": port, **checks})
+
+    def query(self, server: str) -> dict:
+        return self.request({"type": "QUERY", "server": server})
+
+    def query_many(self, servers: list[str], rank: bool = False) -> dict[str, dict]:
+        res = self.request({"type": "QUERY_MANY", "servers": list(servers), "rank": rank})
+        if rank:
+            return {name: res["servers"][name] for name in res["ranked"]}
+        return res["servers"]
+
+    def list(self, rank: bool = False) -> dict[str, dict]:
+        # With rank, servers come back least loaded first.
+        return self.request({"type": "LIST", "rank": rank})["servers"]
+
+    def stats(self) -> dict:
+        return self.request({"type": "STATS"})
+
+    def list_since(self, version: int) -> dict:
+        return self.request({"type": "LIST", "since": version})
+
+    def apply(self, delta: dict):
+        if delta.get("reset") or "removed" not in delta:
+            self.servers = dict(delta["servers"])
+        else:
+            self.servers.update(delta["servers"])
+            for name in delta["removed"]:
+                self.servers.pop(name, None)
+        self.version = delta["version"]
+
+    def sync(self) -> dict[str, dict]:
+        # Keeps self.servers current, fetching only what changed since the last call.
+        self.apply(self.request({"type": "LIST"}) if self.version is None else self.list_since(self.version))
+        return self.servers
+
+    def watch(self, since: int | None = None) -> Iterator[dict]:
+        # Holds its own connection. The first message is a LIST-style snapshot or delta,
+        # then one {"version", "server", "info"} event per change; info is None once removed
+        # and heartbeats carry only "version".
+        with protocol.Connection.open(self.address, timeout=self.timeout) as conn:
+            conn.sock.settimeout(WATCH_TIMEOUT)
+            conn.send(json.dumps({"type": "WATCH", "since": since}).encode())
+            while True:
+                yield json.loads(conn.recv())
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,190 @@
+import json
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Iterable
+from urllib.parse import quote
+
+import records
+from mail_client import MailClient
+
+PAGE_SIZE = 1000
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".potato-mail")
+
+# File layout, zlib-compressed as a whole: "MC" | format version (1B) | meta length (4B)
+# | meta JSON (epoch, version, summaries) | records.encode_batch of the cached bodies, LRU first.
+FILE = struct.Struct("!2sBI")
+FILE_MAGIC = b"MC"
+FILE_VERSION = 1
+
+
+def cache_path(server: str, user: str) -> str:
+    return os.path.join(CACHE_DIR, f"{quote(server, safe='')}-{quote(user, safe='')}.cache")
+
+
+def body_size(mail: dict) -> int:
+    return len(mail["body"].encode()) + sum(len(mail[f].encode()) for f in records.TEXT_FIELDS)
+
+
+class MailCache:
+    # Client-side copy of one user's mailbox on top of a MailClient. The summary list follows
+    # the server with LIST::SINCE deltas against the mailbox version (full pages only on first
+    # use, a reset or a new store epoch); bodies are fetched on first read or prefetch and kept
+    # in an LRU bounded by size. With a path the lot is saved on save() and loaded on start.
+    def __init__(self, client: MailClient, path: str | None = None, max_bytes: int = 16 * 1024 * 1024):
+        self.client = client
+        self.path = path
+        self.max_bytes = max_bytes
+        self.epoch: int | None = None
+        self.version = 0
+        self.mails: dict[str, dict] = {}
+        self._bodies: OrderedDict[str, dict] = OrderedDict()
+        self._size = 0
+        self._pending: dict[str, Future] = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            self.load()
+
+    def view(self) -> list[dict]:
+        # The list as last synced plus local deletes, without asking the server.
+        return list(self.mails.values())
+
+    def sync(self) -> list[dict]:
+        if self.epoch is not None:
+            delta = self.client.changes(self.version)
+            if delta.get("epoch") == self.epoch and not delta.get("reset"):
+                self._apply(delta)
+                return self.view()
+        self._refetch()
+        return self.view()
+
+    def _refetch(self):
+        first = page = self.client.list(PAGE_SIZE)
+        mails = {}
+        while True:
+            for m in page["mails"]:
+                mails[m["id"]] = m
+            if page["next"] is None:
+                break
+            page = self.client.list(PAGE_SIZE, page["next"])
+        self.mails, self.version, self.epoch = mails, first["version"], first.get("epoch")
+        # Later pages already include mail added meanwhile; this catches what was removed.
+        delta = self.client.changes(self.version)
+        if delta.get("epoch") == self.epoch and not delta.get("reset"):
+            self._apply(delta)
+        with self._lock:
+            for mid in [mid for mid in self._bodies if mid not in self.mails]:
+                self._drop(mid)
+
+    def _apply(self, delta: dict):
+        for mid in delta["removed"]:
+            self.forget(mid)
+        for m in delta["added"]:
+            self.mails[m["id"]] = m
+        self.version = delta["version"]
+
+    def read_async(self, mid: str) -> Future[dict | None]:
+        with self._lock:
+            mail = self._bodies.get(mid)
+            if mail is not None:
+                self._bodies.move_to_end(mid)
+                self.hits += 1
+                fut = Future()
+                fut.set_result(mail)
+                return fut
+            fut = self._pending.get(mid)
+            if fut is None:
+                self.misses += 1
+                fut = self._fetch(mid)
+        return fut
+
+    def read(self, mid: str) -> dict | None:
+        return self.read_async(mid).result(self.client.timeout)
+
+    def prefetch(self, mids: Iterable[str]):
+        # Only bodies not cached or already on the way are requested, all in one pipelined burst.
+        with self._lock:
+            for mid in mids:
+                if mid not in self._bodies and mid not in self._pending:
+                    self._fetch(mid)
+
+    def _fetch(self, mid: str) -> Future[dict | None]:
+        # Called with the lock held (reentrant: a reply that is already in runs _arrived right here).
+        fut = self._pending[mid] = self.client.read_async(mid)
+        fut.add_done_callback(lambda f: self._arrived(mid, f))
+        return fut
+
+    def _arrived(self, mid: str, fut: Future):
+        with self._lock:
+            self._pending.pop(mid, None)
+            if fut.exception() is None and fut.result() is not None:
+                self._store(fut.result())
+
+    def _store(self, mail: dict):
+        size = body_size(mail)
+        if size > self.max_bytes:
+            return
+        self._drop(mail["id"])
+        self._bodies[mail["id"]] = mail
+        self._size += size
+        while self._size > self.max_bytes:
+            _, old = self._bodies.popitem(last=False)
+            self._size -= body_size(old)
+
+    def _drop(self, mid: str):
+        mail = self._bodies.pop(mid, None)
+        if mail is not None:
+            self._size -= body_size(mail)
+
+    def forget(self, mid: str):
+        self.mails.pop(mid, None)
+        with self._lock:
+            self._drop(mid)
+
+    def delete(self, mid: str) -> bool:
+        # The next delta lists the id as removed as well; dropping it now keeps the view current.
+        if not self.client.delete(mid):
+            return False
+        self.forget(mid)
+        return True
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            bodies = [mail for mail in self._bodies.values() if records.fits(mail)]
+        meta = json.dumps({"epoch": self.epoch, "version": self.version, "mails": list(self.mails.values())}).encode()
+        data = zlib.compress(FILE.pack(FILE_MAGIC, FILE_VERSION, len(meta)) + meta + records.encode_batch(bodies), 1)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+    def load(self):
+        # A missing, foreign or damaged file just means a cold start.
+        try:
+            with open(self.path, "rb") as f:
+                data = zlib.decompress(f.read())
+            magic, version, n_meta = FILE.unpack_from(data)
+            if magic != FILE_MAGIC or version != FILE_VERSION:
+                return
+            meta = json.loads(data[FILE.size:FILE.size + n_meta])
+            bodies = records.decode_batch(data[FILE.size + n_meta:])
+        except (OSError, ValueError, zlib.error, struct.error):
+            return
+        self.epoch, self.version = meta["epoch"], meta["version"]
+        self.mails = {m["id"]: m for m in meta["mails"]}
+        with self._lock:
+            for mail in bodies:
+                self._store(mail)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"mails": len(self.mails), "bodies": len(self._bodies), "body_bytes": self._size,
+                    "hits": self.hits, "misses": self.misses}
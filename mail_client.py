@@ -0,0 +1,134 @@
+import itertools
+import json
+import socket
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Iterable
+
+import protocol
+import records
+
+PIPELINE_CAP = "rid"
+
+
+def then(fut: Future, fn: Callable) -> Future:
+    out = Future()
+
+    def done(f: Future):
+        try:
+            out.set_result(fn(f.result()))
+        except Exception as e:
+            out.set_exception(e)
+
+    fut.add_done_callback(done)
+    return out
+
+
+class MailClient:
+    # One framed connection to a mail server with any number of requests in flight. Once the
+    # server has offered "rid" at LOGIN every request carries an id and replies are matched by
+    # it; before that (or with an older server) replies are matched in order. A reader thread
+    # completes the futures; request() and the helpers below simply wait on them.
+    def __init__(self, address: tuple[str, int], timeout: float | None = 30.0):
+        self.conn = protocol.Connection.open(address, timeout=timeout)
+        self.conn.sock.settimeout(None)
+        self.timeout = timeout
+        self.caps: set[str] = set()
+        self.compress = False
+        self._ids = itertools.count(1)
+        self._tagged: dict[int, Future] = {}
+        self._untagged: deque[Future] = deque()
+        self._lock = threading.Lock()
+        self._error: Exception | None = None
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def _read_loop(self):
+        reader = self.conn.reader
+        try:
+            while True:
+                data, _ = reader.read_message()
+                if data is None:
+                    raise ConnectionError("connection closed by server")
+                with self._lock:
+                    if reader.rid is not None:
+                        fut = self._tagged.pop(reader.rid, None)
+                    else:
+                        fut = self._untagged.popleft() if self._untagged else None
+                if fut is not None:
+                    fut.set_result(data)
+        except Exception as e:
+            with self._lock:
+                self._error = e if not isinstance(e, OSError) else ConnectionError(str(e))
+                waiting = [*self._tagged.values(), *self._untagged]
+                self._tagged.clear()
+                self._untagged.clear()
+            for fut in waiting:
+                fut.set_exception(self._error)
+
+    def submit(self, payload: bytes) -> Future[bytes]:
+        fut = Future()
+        with self._lock:
+            if self._error is not None:
+                raise self._error
+            if PIPELINE_CAP in self.caps:
+                rid = next(self._ids) & 0xFFFFFFFF
+                self._tagged[rid] = fut
+            else:
+                rid = None
+                self._untagged.append(fut)
+            # Sending under the lock keeps untagged requests in the order their futures were queued.
+            protocol.send_frame(self.conn.sock, payload, 0, self.compress, rid)
+        return fut
+
+    def request(self, payload: bytes) -> bytes:
+        return self.submit(payload).result(self.timeout)
+
+    def send(self, payload: bytes):
+        self.submit(payload)
+
+    def login(self, uid: str, pw: str) -> bool:
+        res = self.request(f"LOGIN::{uid}::{pw}::{','.join(protocol.CAPS)}".encode()).decode()
+        status, *caps = res.split("::")
+        with self._lock:
+            self.caps = set(caps[0].split(",")) if caps else set()
+            self.compress = "zlib" in self.caps
+        return status == "OK"
+
+    def list(self, limit: int = 50, cursor: int | None = None) -> dict:
+        return json.loads(self.request(f"LIST::{limit}::{'' if cursor is None else cursor}".encode()))
+
+    def changes(self, since: int) -> dict:
+        return json.loads(self.request(f"LIST::SINCE::{since}".encode()))
+
+    def read_async(self, mid: str) -> Future[dict | None]:
+        return then(self.submit(f"READ::{mid}".encode()), records.parse_read)
+
+    def read(self, mid: str) -> dict | None:
+        return self.read_async(mid).result(self.timeout)
+
+    def read_many(self, mids: Iterable[str]) -> dict[str, Future[dict | None]]:
+        # All READs go out back to back: one round trip for the lot instead of one each.
+        return {mid: self.read_async(mid) for mid in mids}
+
+    def send_mail(self, to: str, subject: str, body: str) -> str:
+        return self.request(f"SEND::{to}::{subject}::{body}".encode()).decode()
+
+    def delete(self, mid: str) -> bool:
+        return self.request(f"DELETE::{mid}".encode()) == b"DELETE_OK"
+
+    def search(self, query: str, limit: int = 50, cursor: int | None = None) -> dict:
+        return json.loads(self.request(f"SEARCH::{query}::{limit}::{'' if cursor is None else cursor}".encode()))
+
+    def close(self):
+        try:
+            self.conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,52 @@
+import itertools
+import os
+import time
+import zlib
+
+# 128-bit id, written as 32 hex digits so string order is time order:
+#   milliseconds since the Unix epoch (48) | sequence (24) | node (32) | pid (24)
+# The sequence comes from itertools.count, whose next() is atomic under the GIL, so
+# threads never share a lock. It is added rather than masked into its 24 bits: every 2^24
+# ids carry one into the millisecond part instead of wrapping to 0, which keeps ids
+# increasing at any rate, at the cost of the timestamp running 1 ms ahead per 2^24 ids
+# issued. Node (crc32 of the server name) and pid keep ids from different servers and
+# from worker processes of one server apart.
+SEQ_BITS, NODE_BITS, PID_BITS = 24, 32, 24
+SEQ_MASK = (1 << SEQ_BITS) - 1
+PID_MASK = (1 << PID_BITS) - 1
+PREFIX = "mail_"
+
+
+class MailIdGenerator:
+    def __init__(self, node: str):
+        self.node = zlib.crc32(node.encode())
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # The millisecond part follows the monotonic clock from a wall-clock anchor, so a
+        # clock step never makes ids go backwards within a process.
+        self._anchor_ms = time.time_ns() // 1_000_000
+        self._anchor_ns = time.monotonic_ns()
+        self._seq = itertools.count()
+        self._low = (self.node << PID_BITS) | (os.getpid() & PID_MASK)
+        self._suffix = f"{self._low:014x}"
+
+    def _high(self) -> int:
+        seq = next(self._seq)
+        return ((self._anchor_ms + (time.monotonic_ns() - self._anchor_ns) // 1_000_000) << SEQ_BITS) + seq
+
+    def __call__(self) -> str:
+        # Node and pid never change within a process, so only the high 72 bits are formatted per id.
+        return f"{PREFIX}{self._high():018x}{self._suffix}"
+
+
+def timestamp_ms(mail_id: str) -> int | None:
+    # Creation time of an id from MailIdGenerator; None for older "mail_<ms>" ids and anything else.
+    digits = mail_id.removeprefix(PREFIX)
+    if len(digits) != 32:
+        return None
+    try:
+        return int(digits, 16) >> (SEQ_BITS + NODE_BITS + PID_BITS)
+    except ValueError:
+        return None
@@ -0,0 +1,226 @@
+import itertools
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import deque
+from contextlib import contextmanager
+from operator import attrgetter
+from typing import Iterator
+
+from records import MailRecord
+from search import MailIndex, Query
+from storage import MemoryBackend
+
+SUMMARY_FIELDS = ("id", "sender", "subject", "date")
+
+
+def summary(mail: dict | MailRecord) -> dict:
+    return {k: mail[k] for k in SUMMARY_FIELDS}
+
+
+class Mailbox:
+    REMOVED_HISTORY = 4096
+
+    # dict keeps both the id index and arrival order: O(1) get/remove, ordered iteration.
+    # Every add/remove bumps the version, kept on the record; _versions/_ids map add-versions
+    # to ids for cursor paging, as a flat array rather than a tuple per mail.
+    def __init__(self):
+        self._mails: dict[str, MailRecord] = {}
+        self._versions = array("q")
+        self._ids: list[str] = []
+        self._removed: deque[tuple[int, str]] = deque()
+        self._removed_floor = 0
+        self.version = 0
+        self.index = MailIndex()
+
+    def __len__(self) -> int:
+        return len(self._mails)
+
+    def __contains__(self, mid: str) -> bool:
+        return mid in self._mails
+
+    def __iter__(self) -> Iterator[MailRecord]:
+        return iter(self._mails.values())
+
+    def add(self, mail: dict) -> bool:
+        mid = mail["id"]
+        if mid in self._mails:
+            return False
+        self.version += 1
+        record = self._mails[mid] = MailRecord.from_mail(mail, self.version)
+        self._versions.append(self.version)
+        self._ids.append(record.id)
+        self.index.add(mail)
+        return True
+
+    def get(self, mid: str) -> MailRecord | None:
+        return self._mails.get(mid)
+
+    def remove(self, mid: str) -> MailRecord | None:
+        record = self._mails.pop(mid, None)
+        if record is None:
+            return None
+        self.version += 1
+        self.index.remove(record.to_dict())
+        self._removed.append((self.version, mid))
+        if len(self._removed) > self.REMOVED_HISTORY:
+            self._removed_floor = self._removed.popleft()[0]
+        if len(self._ids) > 2 * len(self._mails) + 64:
+            self._ids = list(self._mails)
+            self._versions = array("q", (r.version for r in self._mails.values()))
+        return record
+
+    def _live_after(self, version: int) -> Iterator[MailRecord]:
+        i = bisect_right(self._versions, version)
+        for v, mid in zip(itertools.islice(self._versions, i, None), itertools.islice(self._ids, i, None)):
+            record = self._mails.get(mid)
+            if record is not None and record.version == v:
+                yield record
+
+    def page(self, cursor: int, limit: int) -> tuple[list[MailRecord], int | None]:
+        mails = []
+        for record in self._live_after(cursor):
+            if len(mails) == limit:
+                return mails, mails[-1].version
+            mails.append(record)
+        return mails, None
+
+    def search(self, query: Query, cursor: int, limit: int) -> tuple[list[MailRecord], int | None, int]:
+        ids = self.index.match(query)
+        candidates = self._mails.values() if ids is None else (self._mails[mid] for mid in ids)
+        hits = sorted((r for r in candidates if query.in_range(r)), key=attrgetter("version"))
+        i = bisect_right(hits, cursor, key=attrgetter("version"))
+        page = hits[i:i + limit]
+        nxt = page[-1].version if i + limit < len(hits) else None
+        return page, nxt, len(hits)
+
+    def forget_history(self):
+        self._removed.clear()
+        self._removed_floor = self.version
+
+    def changes(self, since: int) -> tuple[list[MailRecord], list[str]] | None:
+        if since < self._removed_floor or since > self.version:
+            return None
+        added = list(self._live_after(since))
+        removed = [mid for v, mid in self._removed if v > since]
+        return added, removed
+
+
+class StripedLock:
+    def __init__(self, stripes: int = 64):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        # Per-stripe counters are only touched while that stripe is held.
+        self._acquired = [0] * stripes
+        self._contended = [0] * stripes
+
+    @contextmanager
+    def hold(self, key: str):
+        i = hash(key) % len(self._locks)
+        lock = self._locks[i]
+        if not lock.acquire(blocking=False):
+            lock.acquire()
+            self._contended[i] += 1
+        self._acquired[i] += 1
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def stats(self) -> dict:
+        return {
+            "stripes": len(self._locks),
+            "acquired": sum(self._acquired),
+            "contended": sum(self._contended),
+        }
+
+
+class MailStore:
+    def __init__(self, stripes: int = 64, backend=None):
+        self.locks = StripedLock(stripes)
+        self.backend = backend or MemoryBackend()
+        self._boxes: dict[str, Mailbox] = {}
+        # Versions only mean something within one run of the store; clients holding a version
+        # from another epoch have to start over.
+        self.epoch = time.time_ns() // 1_000_000
+
+    @property
+    def durable(self) -> bool:
+        return self.backend.durable
+
+    def recover(self) -> list[tuple[dict, str]]:
+        mails, pending = self.backend.open()
+        for user, mail in mails:
+            self._box(user).add(mail)
+        # Versions restart on recovery, so no pre-restart SINCE cursor may be answered with a delta.
+        for box in self._boxes.values():
+            box.forget_history()
+        return pending
+
+    def _box(self, user: str) -> Mailbox:
+        box = self._boxes.get(user)
+        if box is None:
+            box = self._boxes[user] = Mailbox()
+        return box
+
+    def deliver(self, user: str, mail: dict, journal: bool = True) -> bool:
+        with self.locks.hold(user):
+            if not self._box(user).add(mail):
+                return False
+            token = self.backend.put(user, mail) if journal else 0
+        self.backend.commit(token)
+        return True
+
+    def summaries(self, user: str) -> list[dict]:
+        with self.locks.hold(user):
+            box = self._boxes.get(user, ())
+            return [summary(m) for m in box]
+
+    def page(self, user: str, cursor: int, limit: int) -> dict:
+        with self.locks.hold(user):
+            box = self._boxes.get(user)
+            if box is None:
+                return {"version": 0, "epoch": self.epoch, "mails": [], "next": None}
+            mails, nxt = box.page(cursor, limit)
+            return {"version": box.version, "epoch": self.epoch, "mails": [summary(m) for m in mails], "next": nxt}
+
+    def changes(self, user: str, since: int) -> dict:
+        with self.locks.hold(user):
+            box = self._boxes.get(user)
+            if box is None:
+                return {"version": 0, "epoch": self.epoch, "added": [], "removed": []}
+            delta = box.changes(since)
+            if delta is None:
+                return {"version": box.version, "epoch": self.epoch, "reset": True}
+            added, removed = delta
+            return {"version": box.version, "epoch": self.epoch, "added": [summary(m) for m in added],
+                    "removed": removed}
+
+    def search(self, user: str, query: Query, cursor: int, limit: int) -> dict:
+        with self.locks.hold(user):
+            box = self._boxes.get(user)
+            if box is None:
+                return {"version": 0, "mails": [], "next": None, "total": 0}
+            mails, nxt, total = box.search(query, cursor, limit)
+            return {"version": box.version, "mails": [summary(m) for m in mails], "next": nxt, "total": total}
+
+    def get(self, user: str, mid: str) -> dict | None:
+        with self.locks.hold(user):
+            box = self._boxes.get(user)
+            record = box.get(mid) if box else None
+        return record.to_dict() if record else None
+
+    def record(self, user: str, mid: str) -> MailRecord | None:
+        # The stored record itself, body possibly still compressed, for encoding straight to the wire.
+        with self.locks.hold(user):
+            box = self._boxes.get(user)
+            return box.get(mid) if box else None
+
+    def delete(self, user: str, mid: str) -> bool:
+        with self.locks.hold(user):
+            box = self._boxes.get(user)
+            if not (box and box.remove(mid)):
+                return False
+            token = self.backend.delete(user, mid)
+        self.backend.commit(token)
+        return True
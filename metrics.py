@@ -0,0 +1,185 @@
+import bisect
+import logging
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LatencyWindow:
+    # The last `size` samples, enough for a p99 that tracks current load rather than uptime.
+    def __init__(self, size: int = 1024):
+        self._samples: deque[float] = deque(maxlen=size)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, p: float) -> float:
+        samples = sorted(self._samples)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n: int = 1):
+        with self._lock:
+            self.value += n
+
+    def dec(self, n: int = 1):
+        with self._lock:
+            self.value -= n
+
+
+class Watermark:
+    # Engages at high and stays engaged until the value falls back to low.
+    def __init__(self, high: int, low: int | None = None):
+        self.high = high
+        self.low = int(high * 0.8) if low is None else low
+        self.engaged = False
+        self.rejected = 0
+
+    def update(self, value: int) -> bool:
+        if self.engaged and value <= self.low:
+            self.engaged = False
+        elif not self.engaged and value >= self.high:
+            self.engaged = True
+        return self.engaged
+
+    def admit(self, value: int, incoming: int = 1) -> bool:
+        if self.update(value) or value + incoming > self.high:
+            self.rejected += 1
+            return False
+        return True
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-th observation.
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def _labels(labels: tuple[tuple[str, object], ...]) -> str:
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+
+def _key(labels: tuple[tuple[str, object], ...]) -> str:
+    return ",".join(f"{k}={v}" for k, v in labels) or "all"
+
+
+class Metrics:
+    # Counters and histograms keyed by name and labels, plus gauges read on demand. snapshot()
+    # feeds the STATS command, render() the Prometheus text exporter.
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.histograms: dict[str, dict[tuple, Histogram]] = {}
+        self.gauges: dict[str, Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, n: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + n
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = Histogram()
+            hist.observe(value)
+
+    def gauge(self, name: str, read: Callable[[], float]):
+        self.gauges[name] = read
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = {
+                name: {_key(key): value for key, value in series.items()}
+                for name, series in self.counters.items()
+            }
+            histograms = {
+                name: {
+                    _key(key): {
+                        "count": h.count,
+                        "mean_ms": round(h.sum / h.count * 1000, 3) if h.count else 0.0,
+                        "p50_ms": h.quantile(0.5) * 1000,
+                        "p99_ms": h.quantile(0.99) * 1000,
+                    }
+                    for key, h in series.items()
+                }
+                for name, series in self.histograms.items()
+            }
+        return {"counters": counters, "histograms": histograms,
+                "gauges": {name: read() for name, read in self.gauges.items()}}
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in self.counters.items():
+                lines.append(f"# TYPE {self.prefix}_{name} counter")
+                lines.extend(f"{self.prefix}_{name}{_labels(key)} {value}" for key, value in series.items())
+            for name, series in self.histograms.items():
+                full = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {full} histogram")
+                for key, h in series.items():
+                    seen = 0
+                    for bound, n in zip(h.buckets, h.counts):
+                        seen += n
+                        lines.append(f"{full}_bucket{_labels(key + (('le', bound),))} {seen}")
+                    lines.append(f"{full}_bucket{_labels(key + (('le', '+Inf'),))} {h.count}")
+                    lines.append(f"{full}_sum{_labels(key)} {h.sum}")
+                    lines.append(f"{full}_count{_labels(key)} {h.count}")
+        for name, read in self.gauges.items():
+            lines.append(f"# TYPE {self.prefix}_{name} gauge")
+            lines.append(f"{self.prefix}_{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        logging.getLogger("metrics").info(f"Metrics exporter on http://{host}:{port}/metrics")
+        return httpd
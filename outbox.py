@@ -0,0 +1,170 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from collections import deque
+
+
+class Destination:
+    __slots__ = ("name", "queue", "inflight", "failures", "next_attempt", "runnable", "deferred_since")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.queue: deque[tuple] = deque()
+        self.inflight = 0
+        self.failures = 0
+        self.next_attempt = 0.0
+        self.runnable = False
+        self.deferred_since = 0.0
+
+
+class OutboxScheduler:
+    # Mail is queued FIFO per destination. claim() hands runnable destinations to workers,
+    # at most per_destination at a time (1 keeps delivery order strict); backed-off
+    # destinations sit on a timer heap keyed by their next attempt.
+    def __init__(self, base_delay: float = 5.0, max_delay: float = 300.0, jitter: float = 0.2,
+                 per_destination: int = 1):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.per_destination = per_destination
+        self.destinations: dict[str, Destination] = {}
+        self._runnable: deque[Destination] = deque()
+        self._timers: list[tuple[float, int, str]] = []
+        self._seq = itertools.count()
+        self._pending = 0
+        self._kicked = False
+        self._cond = threading.Condition()
+
+    def __len__(self) -> int:
+        return self._pending
+
+    def _mark(self, dest: Destination):
+        if (not dest.runnable and len(dest.queue) > dest.inflight
+                and dest.inflight < self.per_destination and dest.next_attempt <= time.monotonic()):
+            dest.runnable = True
+            self._runnable.append(dest)
+
+    def _release(self, dest: Destination):
+        dest.inflight -= 1
+        if not dest.queue and not dest.inflight and not dest.failures:
+            self.destinations.pop(dest.name, None)
+        else:
+            self._mark(dest)
+        self._cond.notify()
+
+    def _backoff(self, dest: Destination) -> float:
+        dest.failures += 1
+        delay = min(self.max_delay, self.base_delay * 2 ** (dest.failures - 1))
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        dest.next_attempt = time.monotonic() + delay
+        heapq.heappush(self._timers, (dest.next_attempt, next(self._seq), dest.name))
+        return dest.next_attempt
+
+    def heads(self) -> list[tuple]:
+        with self._cond:
+            return [dest.queue[0] for dest in self.destinations.values() if dest.queue]
+
+    def put(self, item: tuple):
+        with self._cond:
+            dest = self.destinations.get(item[1])
+            if dest is None:
+                dest = self.destinations[item[1]] = Destination(item[1])
+            dest.queue.append(item)
+            self._pending += 1
+            self._mark(dest)
+            self._cond.notify()
+
+    def claim(self) -> list[Destination]:
+        now = time.monotonic()
+        claimed = []
+        with self._cond:
+            while self._timers and self._timers[0][0] <= now:
+                dest = self.destinations.get(heapq.heappop(self._timers)[2])
+                if dest is None:
+                    continue
+                if not dest.queue and not dest.inflight:
+                    del self.destinations[dest.name]
+                else:
+                    self._mark(dest)
+            while self._runnable:
+                dest = self._runnable.popleft()
+                dest.runnable = False
+                dest.inflight += 1
+                claimed.append(dest)
+                self._mark(dest)
+        return claimed
+
+    def kick(self):
+        # Ends the current (or next) wait() early, e.g. for other work the queue loop drives.
+        with self._cond:
+            self._kicked = True
+            self._cond.notify()
+
+    def wait(self, timeout: float):
+        with self._cond:
+            if self._runnable or self._kicked:
+                self._kicked = False
+                return
+            if self._timers:
+                timeout = min(timeout, max(0.0, self._timers[0][0] - time.monotonic()))
+            if timeout > 0:
+                self._cond.wait(timeout)
+            self._kicked = False
+
+    def next_batch(self, dest: Destination, limit: int) -> list[tuple]:
+        with self._cond:
+            if dest.queue and dest.next_attempt <= time.monotonic():
+                batch = [dest.queue.popleft() for _ in range(min(limit, len(dest.queue)))]
+                self._pending -= len(batch)
+                return batch
+            self._release(dest)
+            return []
+
+    def success(self, dest: Destination):
+        with self._cond:
+            dest.failures = 0
+            dest.next_attempt = 0.0
+            dest.deferred_since = 0.0
+
+    def retry(self, dest: Destination, items: list[tuple]) -> float:
+        with self._cond:
+            dest.queue.extendleft(reversed(items))
+            self._pending += len(items)
+            at = self._backoff(dest)
+            self._release(dest)
+            return at
+
+    def wake(self, name: str) -> bool:
+        # Cut a backoff short, e.g. when the registry reports the peer is back.
+        with self._cond:
+            dest = self.destinations.get(name)
+            if dest is None or dest.next_attempt <= time.monotonic():
+                return False
+            dest.next_attempt = 0.0
+            self._mark(dest)
+            self._cond.notify()
+            return True
+
+    def defer(self, dest: Destination, delay: float, items: list[tuple] = ()) -> float:
+        # Step back from a busy peer without counting it as a failure.
+        with self._cond:
+            dest.deferred_since = dest.deferred_since or time.monotonic()
+            dest.queue.extendleft(reversed(items))
+            self._pending += len(items)
+            dest.next_attempt = time.monotonic() + delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+            heapq.heappush(self._timers, (dest.next_attempt, next(self._seq), dest.name))
+            self._release(dest)
+            return dest.next_attempt
+
+    def deferred_for(self, dest: Destination) -> float:
+        # Time since the first deferral that no delivery has followed yet.
+        with self._cond:
+            return time.monotonic() - dest.deferred_since if dest.deferred_since else 0.0
+
+    def fail(self, dest: Destination) -> float:
+        with self._cond:
+            at = self._backoff(dest)
+            self._release(dest)
+            return at
@@ -0,0 +1,102 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import protocol
+
+
+class PeerPool:
+    # Keeps up to `size` idle framed connections per peer address. Connections idle longer
+    # than health_interval are probed with PING before reuse; idle_timeout closes them.
+    # New connections exchange HELLO to agree on compression and binary records.
+    def __init__(self, size: int = 4, idle_timeout: float = 60.0, health_interval: float = 10.0,
+                 connect_timeout: float = 10.0):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.health_interval = health_interval
+        self.connect_timeout = connect_timeout
+        self.opened = 0
+        self.reused = 0
+        self._idle: dict[tuple[str, int] | str, list[tuple[protocol.Connection, float]]] = {}
+        self._lock = threading.Lock()
+        self.log = logging.getLogger("peer")
+
+    def _healthy(self, conn: protocol.Connection) -> bool:
+        try:
+            return conn.request(b"PING") == b"PONG"
+        except Exception:
+            return False
+
+    def acquire(self, addr: tuple[str, int] | str) -> tuple[protocol.Connection, bool]:
+        while True:
+            with self._lock:
+                idle = self._idle.get(addr)
+                if not idle:
+                    break
+                conn, last_used = idle.pop()
+            if time.monotonic() - last_used < self.health_interval or self._healthy(conn):
+                self.reused += 1
+                return conn, True
+            conn.close()
+
+        self.opened += 1
+        conn = protocol.Connection.open(addr, timeout=self.connect_timeout)
+        try:
+            caps = json.loads(conn.request(protocol.HELLO)).get("caps", ())
+        except Exception:
+            conn.close()
+            raise
+        conn.caps = set(caps)
+        # Not worth the CPU on a local Unix socket to a sibling worker.
+        conn.compress = "zlib" in conn.caps and not isinstance(addr, str)
+        return conn, False
+
+    def release(self, addr: tuple[str, int] | str, conn: protocol.Connection):
+        with self._lock:
+            idle = self._idle.setdefault(addr, [])
+            if len(idle) < self.size:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self, addr: tuple[str, int] | str):
+        conn, reused = self.acquire(addr)
+        try:
+            yield conn, reused
+        except BaseException:
+            conn.close()
+            raise
+        self.release(addr, conn)
+
+    def discard(self, addr: tuple[str, int] | str):
+        with self._lock:
+            idle = self._idle.pop(addr, [])
+        for conn, _ in idle:
+            conn.close()
+
+    def evict_idle(self) -> int:
+        cutoff = time.monotonic() - self.idle_timeout
+        stale = []
+        with self._lock:
+            for addr, idle in self._idle.items():
+                stale.extend(conn for conn, last_used in idle if last_used < cutoff)
+                idle[:] = [(conn, last_used) for conn, last_used in idle if last_used >= cutoff]
+        for conn in stale:
+            conn.close()
+        return len(stale)
+
+    def evict_loop(self, stop_event: threading.Event):
+        while not stop_event.wait(self.idle_timeout / 2):
+            evicted = self.evict_idle()
+            if evicted:
+                self.log.debug(f"Closed {evicted} idle peer connection(s)")
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
@@ -0,0 +1,317 @@
+import asyncio
+import itertools
+import socket
+import struct
+import zlib
+from typing import Iterable
+
+# Frame layout: magic(1) | flags(1) | payload length(4, big endian) | payload
+# Legacy peers send bare "CMD::arg" / JSON text, which never starts with MAGIC.
+# FLAG_RID: the message starts with a request id (4, big endian) that the reply echoes, so a
+# client can keep several requests in flight on one connection.
+MAGIC = 0xF0
+FLAG_MORE = 0x01
+FLAG_ZLIB = 0x02
+FLAG_RID = 0x04
+
+HEADER = struct.Struct("!BBI")
+RID = struct.Struct("!I")
+CHUNK_SIZE = 64 * 1024
+MAX_FRAME = 16 * 1024 * 1024
+LEGACY_RECV = 4096
+
+# Readers always accept FLAG_ZLIB frames; writers only compress once the other side has
+# offered "zlib" (LOGIN::id::pw::zlib for clients, HELLO for peers). "binary" switches
+# MAIL_BATCH and READ_OK payloads to records.py encoding; "rid" tells a client it may tag
+# requests with FLAG_RID.
+CAPS = ("zlib", "binary", "rid")
+COMPRESS_MIN = 1024
+COMPRESS_LEVEL = 1
+HELLO = b'{"type": "HELLO", "caps": ["zlib", "binary"]}'
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def deflate(payload: bytes, flags: int) -> tuple[bytes, int]:
+    if len(payload) >= COMPRESS_MIN:
+        packed = zlib.compress(payload, COMPRESS_LEVEL)
+        if len(packed) < len(payload):
+            return packed, flags | FLAG_ZLIB
+    return payload, flags
+
+
+def inflate(payload: bytes) -> bytes:
+    d = zlib.decompressobj()
+    data = d.decompress(payload, MAX_FRAME)
+    if d.unconsumed_tail:
+        raise ProtocolError(f"compressed frame expands past {MAX_FRAME} bytes")
+    return data
+
+
+def untag(payload: bytes | bytearray) -> tuple[int, bytes | bytearray]:
+    if len(payload) < RID.size:
+        raise ProtocolError("tagged frame shorter than its request id")
+    return RID.unpack_from(payload)[0], payload[RID.size:]
+
+
+def frame(payload: bytes, flags: int = 0, compress: bool = False) -> bytes:
+    # With FLAG_RID in flags the payload must already start with the packed id.
+    if compress:
+        payload, flags = deflate(payload, flags)
+    return HEADER.pack(MAGIC, flags, len(payload)) + payload
+
+
+def send_frame(sock: socket.socket, payload: bytes, flags: int = 0, compress: bool = False,
+               rid: int | None = None):
+    if rid is not None:
+        payload, flags = RID.pack(rid) + payload, flags | FLAG_RID
+    if compress:
+        payload, flags = deflate(payload, flags)
+    header = HEADER.pack(MAGIC, flags, len(payload))
+    if len(payload) <= CHUNK_SIZE:
+        sock.sendall(header + payload)
+    else:
+        sock.sendall(header)
+        sock.sendall(payload)
+
+
+def send_stream(sock: socket.socket, chunks: Iterable[bytes], compress: bool = False, rid: int | None = None):
+    # The id goes in front of the first chunk; every frame of the message carries FLAG_RID.
+    flags = 0
+    if rid is not None:
+        chunks, flags = itertools.chain((RID.pack(rid),), chunks), FLAG_RID
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        if len(buf) >= CHUNK_SIZE:
+            send_frame(sock, bytes(buf) if compress else buf, flags | FLAG_MORE, compress)
+            buf = bytearray()
+    send_frame(sock, bytes(buf) if compress else buf, flags, compress)
+
+
+def reply(sock: socket.socket, payload: bytes, framed: bool, compress: bool = False, rid: int | None = None):
+    if framed:
+        send_frame(sock, payload, 0, compress, rid)
+    else:
+        sock.sendall(payload)
+
+
+def reply_stream(sock: socket.socket, chunks: Iterable[bytes], framed: bool, compress: bool = False,
+                 rid: int | None = None):
+    if framed:
+        send_stream(sock, chunks, compress, rid)
+    else:
+        # Legacy readers take one recv() per reply, so keep it in a single write.
+        sock.sendall(b"".join(chunks))
+
+
+def respond(sock: socket.socket, res: bytes | Iterable[bytes], framed: bool, compress: bool = False,
+            rid: int | None = None):
+    if isinstance(res, bytes):
+        reply(sock, res, framed, compress, rid)
+    else:
+        reply_stream(sock, res, framed, compress, rid)
+
+
+async def respond_async(writer: asyncio.StreamWriter, res: bytes | Iterable[bytes], framed: bool,
+                        compress: bool = False, rid: int | None = None):
+    # Header and payload go out in one write: two small segments stall on Nagle + delayed ACK.
+    flags = 0
+    if framed and rid is not None:
+        res = RID.pack(rid) + res if isinstance(res, bytes) else itertools.chain((RID.pack(rid),), res)
+        flags = FLAG_RID
+    if isinstance(res, bytes):
+        writer.write(frame(res, flags, compress) if framed else res)
+    elif framed:
+        buf = bytearray()
+        for chunk in res:
+            buf += chunk
+            if len(buf) >= CHUNK_SIZE:
+                writer.write(frame(bytes(buf), flags | FLAG_MORE, compress))
+                buf = bytearray()
+                await writer.drain()
+        writer.write(frame(bytes(buf), flags, compress))
+    else:
+        writer.write(b"".join(res))
+    await writer.drain()
+
+
+class Session:
+    def __init__(self, addr):
+        self.addr = addr
+        self.user: str | None = None
+        self.closed = False
+        self.compress = False
+        self.binary = False
+        # Worker that owns session.user, set at LOGIN when it is not this one.
+        self.handoff: int | None = None
+
+
+class FrameReader:
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.buf = bytearray()
+        self.pending: tuple[bytes, bool] | None = None
+        # Request id of the message last read, None when it was untagged.
+        self.rid: int | None = None
+
+    def push(self, data: bytes, framed: bool):
+        self.pending = (data, framed)
+
+    def read_message(self) -> tuple[bytes | None, bool]:
+        if self.pending is not None:
+            msg, self.pending = self.pending, None
+            return msg
+
+        self.rid = None
+        if not self.buf:
+            chunk = self.sock.recv(LEGACY_RECV)
+            if not chunk:
+                return None, False
+            self.buf += chunk
+
+        if self.buf[0] != MAGIC:
+            data = bytes(self.buf)
+            self.buf.clear()
+            return data, False
+
+        parts = []
+        while True:
+            flags, payload = self._read_frame()
+            parts.append(inflate(payload) if flags & FLAG_ZLIB else payload)
+            if not flags & FLAG_MORE:
+                break
+        if flags & FLAG_RID:
+            self.rid, parts[0] = untag(parts[0])
+        return (bytes(parts[0]) if len(parts) == 1 else b"".join(parts)), True
+
+    def _need(self, n: int):
+        while len(self.buf) < n:
+            chunk = self.sock.recv(CHUNK_SIZE)
+            if not chunk:
+                raise ConnectionError("connection closed mid-frame")
+            self.buf += chunk
+
+    def _read_frame(self) -> tuple[int, bytearray]:
+        self._need(HEADER.size)
+        magic, flags, length = HEADER.unpack_from(self.buf)
+        if magic != MAGIC:
+            raise ProtocolError(f"bad frame magic 0x{magic:02x}")
+        if length > MAX_FRAME:
+            raise ProtocolError(f"frame too large: {length} bytes")
+        del self.buf[:HEADER.size]
+
+        payload = bytearray(length)
+        take = min(length, len(self.buf))
+        payload[:take] = self.buf[:take]
+        del self.buf[:take]
+
+        pos = take
+        with memoryview(payload) as view:
+            while pos < length:
+                n = self.sock.recv_into(view[pos:])
+                if not n:
+                    raise ConnectionError("connection closed mid-frame")
+                pos += n
+        return flags, payload
+
+
+class AsyncFrameReader:
+    def __init__(self, reader: asyncio.StreamReader):
+        self.reader = reader
+        self.buf = bytearray()
+        self.rid: int | None = None
+
+    async def read_message(self) -> tuple[bytes | None, bool]:
+        self.rid = None
+        if not self.buf:
+            chunk = await self.reader.read(LEGACY_RECV)
+            if not chunk:
+                return None, False
+            self.buf += chunk
+
+        if self.buf[0] != MAGIC:
+            data = bytes(self.buf)
+            self.buf.clear()
+            return data, False
+
+        parts = []
+        while True:
+            flags, payload = await self._read_frame()
+            parts.append(inflate(payload) if flags & FLAG_ZLIB else payload)
+            if not flags & FLAG_MORE:
+                break
+        if flags & FLAG_RID:
+            self.rid, parts[0] = untag(parts[0])
+        return (bytes(parts[0]) if len(parts) == 1 else b"".join(parts)), True
+
+    async def _read_frame(self) -> tuple[int, bytes]:
+        if len(self.buf) < HEADER.size:
+            self.buf += await self.reader.readexactly(HEADER.size - len(self.buf))
+        magic, flags, length = HEADER.unpack_from(self.buf)
+        if magic != MAGIC:
+            raise ProtocolError(f"bad frame magic 0x{magic:02x}")
+        if length > MAX_FRAME:
+            raise ProtocolError(f"frame too large: {length} bytes")
+        del self.buf[:HEADER.size]
+
+        take = min(length, len(self.buf))
+        if take == length:
+            payload = bytes(self.buf[:take])
+        else:
+            payload = bytes(self.buf[:take]) + await self.reader.readexactly(length - take)
+        del self.buf[:take]
+        return flags, payload
+
+
+class Connection:
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.reader = FrameReader(sock)
+        self.compress = False
+        self.caps: set[str] = set()
+
+    @classmethod
+    def open(cls, address: tuple[str, int] | str, timeout: float | None = None) -> "Connection":
+        # A str address is a Unix socket path (workers of one server talking to each other).
+        if isinstance(address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            try:
+                sock.connect(address)
+            except OSError:
+                sock.close()
+                raise
+            return cls(sock)
+        return cls(socket.create_connection(address, timeout=timeout))
+
+    def send(self, payload: bytes):
+        send_frame(self.sock, payload, 0, self.compress)
+
+    def recv(self) -> bytes:
+        data, _ = self.reader.read_message()
+        if data is None:
+            raise ConnectionError("connection closed by peer")
+        return data
+
+    def request(self, payload: bytes) -> bytes:
+        self.send(payload)
+        return self.recv()
+
+    def login(self, uid: str, pw: str) -> bool:
+        res = self.request(f"LOGIN::{uid}::{pw}::{','.join(CAPS)}".encode()).decode()
+        status, *caps = res.split("::")
+        self.caps = set(caps[0].split(",")) if caps else set()
+        self.compress = "zlib" in self.caps
+        return status == "OK"
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,135 @@
+import json
+import struct
+import sys
+import zlib
+
+# Mail record, schema version 1:
+#   magic "MR"(2) | version(1) | flags(1) | id, sender, receiver, subject, date lengths (2 each)
+#   | body length(4) | the six fields as UTF-8 bytes, in that order
+# FLAG_BODY_ZLIB means the body bytes are zlib-compressed (as kept by the mail store).
+MAGIC = b"MR"
+BATCH_MAGIC = b"MB"
+VERSION = 1
+FLAG_BODY_ZLIB = 0x01
+
+HEADER = struct.Struct("!2sBBHHHHHI")
+BATCH = struct.Struct("!2sBI")
+TEXT_FIELDS = ("id", "sender", "receiver", "subject", "date")
+FIELD_MAX = 0xFFFF
+BODY_COMPRESS_MIN = 256
+
+
+class MailRecord:
+    # In-memory form of a stored mail: no per-mail dict, no constant "type" key, sender and
+    # receiver interned so a mailbox holds one copy of each address. Bodies past
+    # BODY_COMPRESS_MIN are kept as zlib bytes and only inflated by to_dict(). Indexing by
+    # field name (mail["date"]) is kept so summaries and encode() work on records directly.
+    __slots__ = ("id", "sender", "receiver", "subject", "body", "date", "version")
+
+    def __init__(self, id: str, sender: str, receiver: str, subject: str, body: str | bytes, date: str,
+                 version: int = 0):
+        self.id = id
+        self.sender = sender
+        self.receiver = receiver
+        self.subject = subject
+        self.body = body
+        self.date = date
+        self.version = version
+
+    @classmethod
+    def from_mail(cls, mail: dict, version: int = 0) -> "MailRecord":
+        body = mail["body"]
+        if isinstance(body, str) and len(body) >= BODY_COMPRESS_MIN:
+            packed = zlib.compress(body.encode())
+            if len(packed) < len(body):
+                body = packed
+        return cls(mail["id"], sys.intern(mail["sender"]), sys.intern(mail["receiver"]), mail["subject"], body,
+                   mail["date"], version)
+
+    def __getitem__(self, field: str):
+        return getattr(self, field)
+
+    def text(self) -> str:
+        return zlib.decompress(self.body).decode() if isinstance(self.body, bytes) else self.body
+
+    def to_dict(self) -> dict:
+        return {"type": "MAIL_TRANSFER", "id": self.id, "sender": self.sender, "receiver": self.receiver,
+                "subject": self.subject, "body": self.text(), "date": self.date}
+
+
+def is_record(data: bytes) -> bool:
+    return data[:2] in (MAGIC, BATCH_MAGIC)
+
+
+def fits(mail: dict | MailRecord) -> bool:
+    # Text fields have 2-byte lengths; a string this short cannot pass FIELD_MAX in UTF-8 (4 bytes a char).
+    return all(len(s) <= FIELD_MAX // 4 or len(s.encode()) <= FIELD_MAX for s in (mail[f] for f in TEXT_FIELDS))
+
+
+def encode_parts(mail: dict | MailRecord) -> list[bytes]:
+    fields = [mail[f].encode() for f in TEXT_FIELDS]
+    if max(map(len, fields)) > FIELD_MAX:
+        raise ValueError(f"mail {mail['id'][:40]} has a field over {FIELD_MAX} bytes; send it as JSON")
+    body, flags = mail["body"], 0
+    if isinstance(body, bytes):
+        flags |= FLAG_BODY_ZLIB
+    else:
+        body = body.encode()
+    return [HEADER.pack(MAGIC, VERSION, flags, *map(len, fields), len(body)), *fields, body]
+
+
+def encode(mail: dict | MailRecord) -> bytes:
+    return b"".join(encode_parts(mail))
+
+
+def encode_batch(mails: list[dict]) -> bytes:
+    parts = [BATCH.pack(BATCH_MAGIC, VERSION, len(mails))]
+    for mail in mails:
+        parts.extend(encode_parts(mail))
+    return b"".join(parts)
+
+
+def decode(data: bytes, offset: int = 0) -> tuple[dict, int]:
+    # Unrolled on purpose: one unpack, then each field sliced and decoded straight from the buffer.
+    magic, version, flags, n_id, n_sender, n_receiver, n_subject, n_date, n_body = HEADER.unpack_from(data, offset)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"not a v{VERSION} mail record")
+    p_sender = offset + HEADER.size + n_id
+    p_receiver = p_sender + n_sender
+    p_subject = p_receiver + n_receiver
+    p_date = p_subject + n_subject
+    p_body = p_date + n_date
+    end = p_body + n_body
+    if end > len(data):
+        raise ValueError("truncated mail record")
+    body = data[p_body:end]
+    mail = {
+        "type": "MAIL_TRANSFER",
+        "id": data[offset + HEADER.size:p_sender].decode(),
+        "sender": data[p_sender:p_receiver].decode(),
+        "receiver": data[p_receiver:p_subject].decode(),
+        "subject": data[p_subject:p_date].decode(),
+        "body": (zlib.decompress(body) if flags & FLAG_BODY_ZLIB else body).decode(),
+        "date": data[p_date:p_body].decode(),
+    }
+    return mail, end
+
+
+def decode_batch(data: bytes) -> list[dict]:
+    magic, version, count = BATCH.unpack_from(data)
+    if magic != BATCH_MAGIC or version != VERSION:
+        raise ValueError(f"not a v{VERSION} mail batch")
+    mails, pos = [], BATCH.size
+    for _ in range(count):
+        mail, pos = decode(data, pos)
+        mails.append(mail)
+    return mails
+
+
+def parse_read(res: bytes) -> dict | None:
+    # READ_OK:: is followed by a binary record for clients that negotiated "binary", JSON otherwise.
+    if not res.startswith(b"READ_OK::"):
+        return None
+    if is_record(res[9:11]):
+        return decode(res, 9)[0]
+    return json.loads(res[9:])
@@ -0,0 +1,85 @@
+import logging
+import threading
+import time
+from typing import Callable
+
+
+class CacheEntry:
+    __slots__ = ("info", "expires", "fetched", "used")
+
+    def __init__(self, info: dict, ttl: float):
+        now = time.monotonic()
+        self.info = info
+        self.fetched = now
+        self.expires = now + ttl
+        self.used = False
+
+
+class CachedResolver:
+    # Positive answers live for ttl, FAIL answers for negative_ttl. Entries that were used
+    # since their last fetch are re-queried in the background once refresh_ahead of their
+    # lifetime has passed, so hot destinations never miss. With query_many the whole
+    # refresh goes out as one request.
+    def __init__(self, query: Callable[[str], dict], ttl: float = 30.0, negative_ttl: float = 5.0,
+                 refresh_ahead: float = 0.8, query_many: Callable[[list[str]], dict[str, dict]] | None = None):
+        self.query = query
+        self.query_many = query_many
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_ahead = refresh_ahead
+        self.hits = 0
+        self.misses = 0
+        self._entries: dict[str, CacheEntry] = {}
+        self._lock = threading.Lock()
+        self.log = logging.getLogger("resolver")
+
+    def _store(self, name: str, info: dict) -> CacheEntry:
+        ttl = self.ttl if info.get("status") == "OK" else self.negative_ttl
+        entry = CacheEntry(info, ttl)
+        with self._lock:
+            self._entries[name] = entry
+        return entry
+
+    def resolve(self, name: str) -> dict:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry.expires > time.monotonic():
+                entry.used = True
+                self.hits += 1
+                return entry.info
+            self.misses += 1
+        return self._store(name, self.query(name)).info
+
+    def update(self, name: str, info: dict):
+        self._store(name, info)
+
+    def invalidate(self, name: str):
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def refresh_loop(self, stop_event: threading.Event, interval: float = 1.0):
+        while not stop_event.wait(interval):
+            now = time.monotonic()
+            with self._lock:
+                due, dead = [], []
+                for name, entry in self._entries.items():
+                    if entry.expires <= now:
+                        dead.append(name)
+                    elif entry.used and now - entry.fetched >= (entry.expires - entry.fetched) * self.refresh_ahead:
+                        due.append(name)
+                for name in dead:
+                    del self._entries[name]
+
+            if due and self.query_many is not None:
+                try:
+                    for name, info in self.query_many(due).items():
+                        self._store(name, info)
+                except Exception as e:
+                    self.log.warning(f"Refresh of {len(due)} name(s) failed: {e}")
+                continue
+
+            for name in due:
+                try:
+                    self._store(name, self.query(name))
+                except Exception as e:
+                    self.log.warning(f"Refresh of <{name}> failed: {e}")
@@ -0,0 +1,82 @@
+import re
+from datetime import datetime
+
+TOKEN = re.compile(r"\w+")
+FIELDS = {"from": "sender", "subject": "subject", "body": "body"}
+
+
+def tokenize(text: str) -> set[str]:
+    return set(TOKEN.findall(text.lower()))
+
+
+class Query:
+    # "from:alice subject:report budget after:2026-01-01 before:2026-02-01"
+    # Bare words match sender, subject or body; every term must match. Dates compare
+    # against the mail's ISO date, after inclusive and before exclusive.
+    def __init__(self, terms: list[tuple[str | None, str]], after: str | None, before: str | None):
+        self.terms = terms
+        self.after = after
+        self.before = before
+
+    @classmethod
+    def parse(cls, text: str) -> "Query":
+        terms, after, before = [], None, None
+        for word in text.split():
+            key, sep, value = word.partition(":")
+            key = key.lower()
+            if sep and key in ("after", "before"):
+                datetime.fromisoformat(value)
+                if key == "after":
+                    after = value
+                else:
+                    before = value
+            elif sep and key in FIELDS:
+                terms.extend((FIELDS[key], token) for token in tokenize(value))
+            else:
+                terms.extend((None, token) for token in tokenize(word))
+        return cls(terms, after, before)
+
+    def in_range(self, mail: dict) -> bool:
+        date = mail["date"]
+        return (self.after is None or date >= self.after) and (self.before is None or date < self.before)
+
+
+class MailIndex:
+    # Postings per (field, term), updated as mail is added to or removed from a mailbox.
+    def __init__(self):
+        self._postings: dict[tuple[str, str], set[str]] = {}
+
+    def _keys(self, mail: dict) -> set[tuple[str, str]]:
+        return {(field, token) for field in FIELDS.values() for token in tokenize(mail.get(field, ""))}
+
+    def add(self, mail: dict):
+        for key in self._keys(mail):
+            self._postings.setdefault(key, set()).add(mail["id"])
+
+    def remove(self, mail: dict):
+        for key in self._keys(mail):
+            ids = self._postings.get(key)
+            if ids is not None:
+                ids.discard(mail["id"])
+                if not ids:
+                    del self._postings[key]
+
+    def _lookup(self, field: str | None, token: str) -> set[str]:
+        if field is not None:
+            return self._postings.get((field, token), set())
+        hits = set()
+        for f in FIELDS.values():
+            hits |= self._postings.get((f, token), set())
+        return hits
+
+    def match(self, query: Query) -> set[str] | None:
+        # None means the query has no terms and every mail is a candidate.
+        if not query.terms:
+            return None
+        sets = sorted((self._lookup(field, token) for field, token in query.terms), key=len)
+        result = set(sets[0])
+        for ids in sets[1:]:
+            if not result:
+                break
+            result &= ids
+        return result
@@ -1,147 +1,488 @@
-import json, socket, threading, sys, logging, time
+import argparse, json, os, socket, threading, logging, time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from queue import Queue, Empty
+from typing import Iterable
+
+import protocol
+import records
+from async_engine import AsyncEngine
+from dns_client import DNSClient
+from mailid import MailIdGenerator
+from mailstore import MailStore
+from metrics import Gauge, LatencyWindow, Metrics, Watermark
+from outbox import Destination, OutboxScheduler
+from peer import PeerPool
+from resolver import CachedResolver
+from search import Query
+from storage import FSYNC_POLICIES, LogBackend
+from workers import WorkerGroup, check_data_dir, spawn, worker_data_dir
+
+COMMANDS = ("LOGIN", "LOGOUT", "LIST", "SEARCH", "READ", "DELETE", "SEND", "STATS")
+PEER_MESSAGES = (b"MAIL_BATCH", b"MAIL_TRANSFER", b"HELLO", b"DELIVER", b"OUTBOX")
+
+
+def command_name(data: bytes) -> str:
+    if data[:1] == b"{":
+        head = data[:64]
+        return next((t.decode() for t in PEER_MESSAGES if t in head), "OTHER")
+    if data[:2] == records.BATCH_MAGIC:
+        return "MAIL_BATCH"
+    if data[:2] == records.MAGIC:
+        return "MAIL_TRANSFER"
+    if data.startswith(b"PING"):
+        return "PING"
+    cmd = data[:16].split(b"::", 1)[0].strip().upper().decode(errors="replace")
+    return cmd if cmd in COMMANDS else "OTHER"
+
+
+def age(mail: dict | None) -> float:
+    if mail is None:
+        return 0.0
+    return max(0.0, (datetime.now(timezone.utc) - datetime.fromisoformat(mail["date"])).total_seconds())
+
+
+class PeerBusy(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"peer busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
 
 class MailServer:
-    def __init__(self, name: str, port: int):
+    def __init__(self, name: str, port: int, stripes: int = 64, backend=None,
+                 outbox_workers: int = 16, per_destination: int = 1, dns_ttl: float = 30.0,
+                 batch_size: int = 64, peer_pool_size: int = 4, peer_idle_timeout: float = 60.0,
+                 peer_health_interval: float = 10.0,
+                 inbox_watermarks: tuple[int, int] = (10000, 8000),
+                 outbox_watermarks: tuple[int, int] = (10000, 8000),
+                 session_watermarks: tuple[int, int] | None = None, metrics_port: int | None = None,
+                 dns_host: str = "127.0.0.1", dns_port: int = 4000, workers: WorkerGroup | None = None):
         self.name = name
+        self.workers = workers
         self.port = port
-        self.dns_host, self.dns_port = "127.0.0.1", 4000
+        self.dns_host, self.dns_port = dns_host, dns_port
+        self.dns = DNSClient(self.dns_host, self.dns_port)
         self.users = {"u1": "p1", "u2": "p2", "u3": "p3", "u4": "p4"}
-        self.mailbox: dict[str, list[dict]] = dict()
+        self.store = MailStore(stripes, backend)
+        self.mail_ids = MailIdGenerator(name)
         self.inbox: Queue[dict] = Queue()
-        self.outbox: Queue[tuple[dict, str, int]] = Queue()
-        self.lock_mailbox = threading.Lock()
         self.stop_event = threading.Event()
         self.max_retries = 3
         self.retry_delay = 5
+        # Past this many seconds of deferral a destination is tried regardless of OVERLOAD,
+        # and BUSY replies count toward max_retries like any other failed attempt.
+        self.max_defer = 300
+        self.outbox = OutboxScheduler(base_delay=self.retry_delay, per_destination=per_destination)
+        self.delivery_pool = ThreadPoolExecutor(max_workers=outbox_workers, thread_name_prefix="outbox")
+        self.resolver = CachedResolver(self.dns.query, ttl=dns_ttl, query_many=self.dns.query_many)
+        self.batch_size = batch_size
+        self.peers = PeerPool(size=peer_pool_size, idle_timeout=peer_idle_timeout, health_interval=peer_health_interval)
+        self.engine: AsyncEngine | None = None
+        self.max_page = 1000
+        self.sessions = Gauge()
+        self.peer_connections = Gauge()
+        self.latency = LatencyWindow()
+        self.metrics_port = metrics_port
+        self.metrics = Metrics("mail")
+        # Past a high watermark new work is refused until the gauge drains to the low one. The
+        # session limit is opt-in and, unlike the queues, never reported as busy to the registry.
+        self.limits = {
+            "inbox": Watermark(*inbox_watermarks),
+            "outbox": Watermark(*outbox_watermarks),
+        }
+        if session_watermarks is not None:
+            self.limits["sessions"] = Watermark(*session_watermarks)
 
         logging.basicConfig(
             level=logging.INFO,
-            format=f"[%(asctime)s] [MAIL:{self.name}] [%(levelname)s] %(message)s",
+            format=f"[%(asctime)s] [MAIL:{self.name}{f'/{workers.index}' if workers else ''}] [%(levelname)s] %(message)s",
             datefmt="%Y-%m-%d %H:%M:%S",
         )
         self.log = logging.getLogger("mail")
+        self.register_gauges()
+
+    def register_gauges(self):
+        m = self.metrics
+        m.gauge("inbox_depth", self.inbox.qsize)
+        m.gauge("inbox_age_seconds", lambda: age(self.inbox_head()))
+        m.gauge("outbox_depth", lambda: len(self.outbox))
+        m.gauge("outbox_age_seconds", lambda: max((age(item[0]) for item in self.outbox.heads()), default=0.0))
+        m.gauge("outbox_destinations", lambda: len(self.outbox.destinations))
+        m.gauge("sessions", lambda: self.sessions.value)
+        m.gauge("peer_connections", lambda: self.peer_connections.value)
+        m.gauge("peer_pool_opened", lambda: self.peers.opened)
+        m.gauge("peer_pool_reused", lambda: self.peers.reused)
+        m.gauge("resolver_hits", lambda: self.resolver.hits)
+        m.gauge("resolver_misses", lambda: self.resolver.misses)
+        m.gauge("lock_contended", lambda: self.store.locks.stats()["contended"])
+        for name, limit in self.limits.items():
+            m.gauge(f"{name}_rejected", lambda limit=limit: limit.rejected)
+
+    def inbox_head(self) -> dict | None:
+        with self.inbox.mutex:
+            return self.inbox.queue[0] if self.inbox.queue else None
+
+    def observe(self, data: bytes, seconds: float):
+        cmd = command_name(data)
+        self.metrics.inc("commands_total", command=cmd)
+        self.metrics.observe("command_seconds", seconds, command=cmd)
 
     def gen_mail_id(self) -> str:
-        return f"mail_{int(time.time() * 1000)}"
+        return self.mail_ids()
 
     def dns_register(self):
-        payload = {"type": "REGISTER", "server": self.name, "ip": "127.0.0.1", "port": self.port}
-        with socket.create_connection((self.dns_host, self.dns_port)) as s:
-            s.sendall(json.dumps(payload).encode())
-            s.recv(1024)
+        self.dns.register(self.name, "127.0.0.1", self.port)
         self.log.info("Registered to DNS")
 
-    def dns_query(self, server: str):
-        payload = {"type": "QUERY", "server": server}
-        with socket.create_connection((self.dns_host, self.dns_port)) as s:
-            s.sendall(json.dumps(payload).encode())
-            return json.loads(s.recv(1024).decode())
+    def send_remote(self, mails: list[dict], target: dict) -> list[bool]:
+        addr = (target["ip"], target["port"])
+        for _ in range(2):
+            reused = False
+            try:
+                with self.peers.connection(addr) as (conn, reused):
+                    if "binary" in conn.caps and all(map(records.fits, mails)):
+                        payload = records.encode_batch(mails)
+                    else:
+                        payload = json.dumps({"type": "MAIL_BATCH", "mails": mails}).encode()
+                    res = conn.request(payload)
+            except Exception as e:
+                if not reused:
+                    self.log.error(f"Remote send error: {e}")
+                    break
+                # The peer dropped a pooled connection (e.g. it restarted); retry on a fresh one.
+                self.peers.discard(addr)
+                continue
+            if res.startswith(b"BUSY::"):
+                raise PeerBusy(float(res[6:]))
+            return [ack == "RECEIVED" for ack in json.loads(res)["acks"]]
+        return [False] * len(mails)
+
+    def is_remote(self, data: bytes) -> bool:
+        return data.startswith(b"PING") or data[:1] == b"{" or records.is_record(data)
+
+    def execute(self, session: protocol.Session, data: bytes) -> bytes | Iterable[bytes]:
+        cmd, *args = data.decode().strip().split("::")
+        cmd = cmd.upper()
 
-    def send_remote(self, mail: dict, target: dict) -> bool:
+        if cmd == "LOGIN":
+            uid, pw, *caps = args
+            if self.users.get(uid) != pw:
+                return b"LOGIN_FAIL"
+            session.user = uid
+            offered = caps[0].split(",") if caps else ()
+            accepted = [c for c in protocol.CAPS if c in offered]
+            session.compress = "zlib" in accepted
+            session.binary = "binary" in accepted
+            if self.workers is not None and not self.workers.owns(uid):
+                session.handoff = self.workers.owner(uid)
+            return f"OK::{','.join(accepted)}".encode() if accepted else b"OK"
+
+        elif cmd == "LOGOUT":
+            session.closed = True
+            return b"BYE"
+
+        elif cmd == "LIST":
+            if not args:
+                result = self.store.summaries(session.user)
+            else:
+                try:
+                    if args[0].upper() == "SINCE":
+                        result = self.store.changes(session.user, int(args[1]))
+                    else:
+                        limit = min(int(args[0]), self.max_page)
+                        if limit < 1:
+                            return b"INVALID_ARGUMENTS"
+                        cursor = int(args[1]) if len(args) > 1 and args[1] else 0
+                        result = self.store.page(session.user, cursor, limit)
+                except (ValueError, IndexError):
+                    return b"INVALID_ARGUMENTS"
+            return (part.encode() for part in json.JSONEncoder().iterencode(result))
+
+        elif cmd == "SEARCH":
+            try:
+                query = Query.parse(args[0])
+                limit = min(int(args[1]), self.max_page) if len(args) > 1 and args[1] else 50
+                cursor = int(args[2]) if len(args) > 2 and args[2] else 0
+            except (ValueError, IndexError):
+                return b"INVALID_ARGUMENTS"
+            if limit < 1:
+                return b"INVALID_ARGUMENTS"
+            result = self.store.search(session.user, query, cursor, limit)
+            return (part.encode() for part in json.JSONEncoder().iterencode(result))
+
+        elif cmd == "STATS":
+            return json.dumps({**self.metrics.snapshot(), "load": self.load()}).encode()
+
+        elif cmd == "READ":
+            mid = args[0]
+            if session.binary:
+                # The stored (possibly compressed) body goes out as is; the client inflates it.
+                mail = self.store.record(session.user, mid)
+                if mail is None:
+                    return b"NOT_FOUND"
+                if records.fits(mail):
+                    return b"READ_OK::" + records.encode(mail)
+                # Peers may deliver fields too long for a record (SEND refuses them); those go out as JSON.
+            mail = self.store.get(session.user, mid)
+            return b"READ_OK::" + json.dumps(mail).encode() if mail else b"NOT_FOUND"
+
+        elif cmd == "DELETE":
+            mid = args[0]
+            return b"DELETE_OK" if self.store.delete(session.user, mid) else b"DELETE_FAIL"
+
+        elif cmd == "SEND":
+            recv_full, subj, body = args
+            try:
+                r_user, r_srv = recv_full.split("@")
+            except ValueError:
+                return b"INVALID_RECEIVER"
+
+            mail = {
+                "type": "MAIL_TRANSFER",
+                "id": self.gen_mail_id(),
+                "sender": f"{session.user}@{self.name}",
+                "receiver": r_user,
+                "subject": subj,
+                "body": body,
+                "date": datetime.now(timezone.utc).isoformat(),
+            }
+            if not records.fits(mail):
+                return b"INVALID_ARGUMENTS"
+
+            if r_srv == self.name:
+                return self.deliver_local(r_user, mail)
+            return self.queue_remote(mail, r_srv)
+
+        return b"INVALID_CMD"
+
+    def deliver_local(self, user: str, mail: dict) -> bytes:
+        if self.workers is not None and not self.workers.owns(user):
+            return self.worker_request(self.workers.owner(user), {"type": "DELIVER", "user": user, "mail": mail})
+        return b"SEND_OK" if self.store.deliver(user, mail) else b"SEND_FAIL"
+
+    def queue_remote(self, mail: dict, target_srv: str) -> bytes:
+        if self.workers is not None and not self.workers.owns_outbox:
+            return self.worker_request(0, {"type": "OUTBOX", "mail": mail, "target": target_srv})
+        if not self.limits["outbox"].admit(len(self.outbox)):
+            return f"SEND_BUSY::{self.retry_delay}".encode()
+        self.store.backend.commit(self.store.backend.out_add(mail, target_srv))
+        self.outbox.put((mail, target_srv, 0))
+        return b"SEND_QUEUED"
+
+    def worker_request(self, index: int, msg: dict) -> bytes:
         try:
-            with socket.create_connection((target["ip"], target["port"]), timeout=10) as s:
-                s.sendall(json.dumps(mail).encode())
-                r = s.recv(1024).decode()
-            return r == "RECEIVED"
+            with self.peers.connection(self.workers.peer_path(index)) as (conn, _):
+                return conn.request(json.dumps(msg).encode())
         except Exception as e:
-            self.log.error(f"Remote send error: {e}")
+            self.log.error(f"Worker {index} unreachable: {e}")
+            return b"SEND_FAIL"
+
+    def may_block(self, data: bytes) -> bool:
+        # Durable SEND/DELETE/MAIL_TRANSFER wait for a group commit before replying. With workers,
+        # SEND and inbound peer mail may also hop to another worker over a blocking Unix socket.
+        if data[:1] == b"{" or records.is_record(data) or data[:6].upper() == b"SEND::":
+            return self.store.durable or self.workers is not None
+        return self.store.durable and data[:6].upper() == b"DELETE"
+
+    def load(self) -> dict:
+        gauges = {"inbox": self.inbox.qsize(), "outbox": len(self.outbox), "sessions": self.sessions.value}
+        return {
+            **gauges,
+            "p99_ms": round(self.latency.percentile(0.99) * 1000, 3),
+            "busy": [name for name in ("inbox", "outbox") if self.limits[name].update(gauges[name])],
+            "rejected": {name: limit.rejected for name, limit in self.limits.items()},
+        }
+
+    def busy(self) -> bytes:
+        return f"BUSY::{self.retry_delay}".encode()
+
+    def admit_session(self) -> bool:
+        limit = self.limits.get("sessions")
+        return limit is None or limit.admit(self.sessions.value)
+
+    def execute_remote(self, data: bytes) -> bytes | None:
+        if data.startswith(b"PING::LOAD"):
+            return f"PONG::{json.dumps(self.load())}".encode()
+        if data.startswith(b"PING"):
+            return b"PONG"
+
+        if data[:2] == records.BATCH_MAGIC:
+            mails = records.decode_batch(data)
+            return json.dumps({"acks": ["RECEIVED"] * len(mails)}).encode() if self.accept(mails) else self.busy()
+        if data[:2] == records.MAGIC:
+            return b"RECEIVED" if self.accept([records.decode(data)[0]]) else self.busy()
+
+        msg = json.loads(data)
+        if msg.get("type") == "HELLO":
+            return json.dumps({"caps": [c for c in protocol.CAPS if c in msg.get("caps", ())]}).encode()
+
+        if msg.get("type") == "DELIVER":
+            return self.deliver_local(msg["user"], msg["mail"])
+        if msg.get("type") == "OUTBOX":
+            return self.queue_remote(msg["mail"], msg["target"])
+
+        if msg.get("type") == "MAIL_TRANSFER":
+            return b"RECEIVED" if self.accept([msg]) else self.busy()
+
+        if msg.get("type") == "MAIL_BATCH":
+            mails = msg["mails"]
+            return json.dumps({"acks": ["RECEIVED"] * len(mails)}).encode() if self.accept(mails) else self.busy()
+        return None
+
+    def accept(self, mails: list[dict]) -> bool:
+        # Journals a transfer from a peer in one group commit and queues it for delivery.
+        # With workers, mail for users owned elsewhere is passed on first; a refusal there
+        # makes the peer retry the whole batch, and the owners drop what they already have.
+        if self.workers is not None:
+            owners: dict[int, list[dict]] = {}
+            for mail in mails:
+                owners.setdefault(self.workers.owner(mail["receiver"]), []).append(mail)
+            mails = owners.pop(self.workers.index, [])
+            for index, theirs in owners.items():
+                if not self.forward(index, theirs):
+                    return False
+            if not mails:
+                return True
+        if not self.limits["inbox"].admit(self.inbox.qsize(), len(mails)):
             return False
+        token = 0
+        for mail in mails:
+            token = self.store.backend.put(mail["receiver"], mail)
+        self.store.backend.commit(token)
+        for mail in mails:
+            self.inbox.put(mail)
+        self.outbox.kick()
+        return True
 
-    def handler_client(self, conn: socket.socket, addr):
-        self.log.info(f"Client {addr} connected")
-        user = None
+    def forward(self, index: int, mails: list[dict]) -> bool:
         try:
-            while not self.stop_event.is_set():
-                data = conn.recv(4096)
-                if not data:
-                    break
+            with self.peers.connection(self.workers.peer_path(index)) as (conn, _):
+                if all(map(records.fits, mails)):
+                    payload = records.encode_batch(mails)
+                else:
+                    payload = json.dumps({"type": "MAIL_BATCH", "mails": mails}).encode()
+                res = conn.request(payload)
+        except Exception as e:
+            self.log.error(f"Worker {index} unreachable: {e}")
+            return False
+        return not res.startswith(b"BUSY::")
 
-                cmd, *args = data.decode().strip().split("::")
-                cmd = cmd.upper()
+    def handler_connection(self, conn: socket.socket, addr):
+        reader = protocol.FrameReader(conn)
+        try:
+            data, framed = reader.read_message()
+        except Exception as e:
+            self.log.error(f"Handshake error from {addr}: {e}")
+            conn.close()
+            return
+        if data is None:
+            conn.close()
+            return
 
-                if cmd == "LOGIN":
-                    uid, pw = args
-                    if self.users.get(uid) == pw:
-                        user = uid
-                        conn.sendall(b"OK")
-                    else:
-                        conn.sendall(b"LOGIN_FAIL")
+        reader.push(data, framed)
+        if self.is_remote(data):
+            self.handler_remote(conn, addr, reader)
+        else:
+            self.handler_client(conn, addr, reader)
+
+    def handler_client(self, conn: socket.socket, addr, reader: protocol.FrameReader):
+        if not self.admit_session():
+            self.log.warning(f"Client {addr} refused: too many sessions")
+            try:
+                protocol.reply(conn, self.busy(), reader.read_message()[1])
+            finally:
+                conn.close()
+            return
 
-                elif cmd == "LOGOUT":
-                    conn.sendall(b"BYE")
+        self.serve_client(conn, reader, protocol.Session(addr))
+
+    def serve_client(self, conn: socket.socket, reader: protocol.FrameReader, session: protocol.Session):
+        self.log.info(f"Client {session.addr} connected")
+        self.sessions.inc()
+        try:
+            while not session.closed and not self.stop_event.is_set():
+                data, framed = reader.read_message()
+                if data is None:
                     break
 
-                elif cmd == "LIST":
-                    with self.lock_mailbox:
-                        mails = self.mailbox.get(user, [])
-                        summary = [
-                            {k: m[k] for k in ("id", "sender", "subject", "date")}
-                            for m in mails
-                        ]
-                    conn.sendall(json.dumps(summary).encode())
-
-                elif cmd == "READ":
-                    mid = args[0]
-                    with self.lock_mailbox:
-                        mail = next((m for m in self.mailbox.get(user, []) if m["id"] == mid), None)
-                    conn.sendall(f"READ_OK::{mail}".encode() if mail else b"NOT_FOUND")
-
-                elif cmd == "DELETE":
-                    mid = args[0]
-                    with self.lock_mailbox:
-                        before = len(self.mailbox.get(user, []))
-                        self.mailbox[user] = [m for m in self.mailbox.get(user, []) if m["id"] != mid]
-                        conn.sendall(b"DELETE_OK" if len(self.mailbox[user]) < before else b"DELETE_FAIL")
-
-                elif cmd == "SEND":
-                    recv_full, subj, body = args
-                    try:
-                        r_user, r_srv = recv_full.split("@")
-                    except ValueError:
-                        conn.sendall(b"INVALID_RECEIVER")
-                        continue
-
-                    mail = {
-                        "type": "MAIL_TRANSFER",
-                        "id": self.gen_mail_id(),
-                        "sender": f"{user}@{self.name}",
-                        "receiver": r_user,
-                        "subject": subj,
-                        "body": body,
-                        "date": datetime.now(timezone.utc).isoformat(),
-                    }
-
-                    if r_srv == self.name:
-                        with self.lock_mailbox:
-                            self.mailbox.setdefault(r_user, []).append(mail)
-                        conn.sendall(b"SEND_OK")
-                    else:
-                        self.outbox.put((mail, r_srv, 0))
-                        conn.sendall(b"SEND_QUEUED")
-                else:
-                    conn.sendall(b"INVALID_CMD")
+                started = time.perf_counter()
+                res = self.execute(session, data)
+                if session.handoff is not None:
+                    # The owning worker sends the LOGIN reply, so nothing else is in flight yet.
+                    if self.hand_off(conn, session, res, framed, reader.rid, bytes(reader.buf)):
+                        break
+                    res, session.closed = self.busy(), True
+                protocol.respond(conn, res, framed, session.compress, reader.rid)
+                elapsed = time.perf_counter() - started
+                self.latency.record(elapsed)
+                self.observe(data, elapsed)
         except Exception as e:
             self.log.exception(f"Client handler error: {e}")
         finally:
+            self.sessions.dec()
             conn.close()
-            self.log.info(f"Client {addr} disconnected")
+            self.log.info(f"Client {session.addr} disconnected")
 
-    def handler_remote(self, conn: socket.socket, addr):
+    def hand_off(self, sock, session: protocol.Session, reply: bytes, framed: bool, rid: int | None,
+                 buffered: bytes) -> bool:
+        state = {"addr": session.addr, "user": session.user, "compress": session.compress,
+                 "binary": session.binary, "framed": framed, "rid": rid, "reply": reply.decode()}
         try:
-            if conn.recv(4, socket.MSG_PEEK) == b"PING":
-                conn.recv(4)
-                conn.sendall(b"PONG")
-                return
+            self.workers.hand_off(session.handoff, sock, state, buffered)
+        except OSError as e:
+            self.log.error(f"Handing {session.user} to worker {session.handoff} failed: {e}")
+            return False
+        self.log.info(f"Client {session.addr} handed to worker {session.handoff}")
+        return True
+
+    def handoff_loop(self, sock: socket.socket):
+        while not self.stop_event.is_set():
+            try:
+                conn, state, buffered = self.workers.receive(sock)
+            except socket.timeout:
+                continue
+            except Exception as e:
+                self.log.error(f"Bad handoff: {e}")
+                continue
+            session = protocol.Session(tuple(state["addr"]))
+            session.user = state["user"]
+            session.compress = state["compress"]
+            session.binary = state["binary"]
+            args = (conn, session, state["reply"].encode(), state["framed"], state["rid"], buffered)
+            if self.engine is not None:
+                self.engine.adopt(*args)
+            else:
+                threading.Thread(target=self.resume_client, args=args, daemon=True).start()
+
+    def resume_client(self, conn: socket.socket, session: protocol.Session, reply: bytes, framed: bool,
+                      rid: int | None, buffered: bytes):
+        conn.setblocking(True)
+        reader = protocol.FrameReader(conn)
+        reader.buf += buffered
+        try:
+            protocol.respond(conn, reply, framed, session.compress, rid)
+        except OSError:
+            conn.close()
+            return
+        self.serve_client(conn, reader, session)
 
-            mail = json.loads(conn.recv(4096).decode())
-            if mail.get("type") == "MAIL_TRANSFER":
-                self.inbox.put(mail)
-                conn.sendall(b"RECEIVED")
+    def handler_remote(self, conn: socket.socket, addr, reader: protocol.FrameReader):
+        self.peer_connections.inc()
+        try:
+            # Peers keep framed connections open and send many transfers over them.
+            while not self.stop_event.is_set():
+                data, framed = reader.read_message()
+                if data is None:
+                    return
+                started = time.perf_counter()
+                res = self.execute_remote(data)
+                if res is not None:
+                    protocol.reply(conn, res, framed, rid=reader.rid)
+                self.observe(data, time.perf_counter() - started)
         except Exception as e:
             self.log.exception(f"Remote handler error: {e}")
         finally:
+            self.peer_connections.dec()
             conn.close()
 
     def process_inbox(self):
@@ -151,87 +492,239 @@ class MailServer:
                 mail = self.inbox.get_nowait()
             except Empty:
                 break
-            with self.lock_mailbox:
-                self.mailbox.setdefault(mail["receiver"], []).append(mail)
+            if not self.store.deliver(mail["receiver"], mail, journal=False):
+                self.log.warning(f"INBOX dropped duplicate mail {mail['id']}")
             self.inbox.task_done()
             processed += 1
         if processed:
             self.log.debug(f"INBOX delivered {processed} mail(s)")
 
-    def process_outbox(self):
-        requeue: list[tuple[dict, str, int]] = []
-        while True:
-            try:
-                mail, target_srv, retries = self.outbox.get_nowait()
-            except Empty:
-                break
-            except Exception as e:
-                self.log.error(f"OUTBOX unpack error: {e}")
-                continue
+    def deliver_remote(self, mails: list[dict], target_srv: str) -> list[bool]:
+        try:
+            target_info = self.resolver.resolve(target_srv)
+        except Exception as e:
+            self.log.error(f"DNS error: {e}")
+            return [False] * len(mails)
+        if target_info.get("status") == "FAIL":
+            # FAIL answers stay cached for negative_ttl; retries must not hit the registry. An
+            # OVERLOAD peer only gets here once drain_destination has stopped deferring to it.
+            return [False] * len(mails)
+        try:
+            acks = self.send_remote(mails, target_info)
+            if any(acks):
+                return acks
+        except PeerBusy:
+            raise
+        except Exception as e:
+            self.log.error(f"Send error: {e}")
+        # The OK answer led nowhere; ask the registry again next time.
+        self.resolver.invalidate(target_srv)
+        return [False] * len(mails)
 
-            try:
-                target_info = self.dns_query(target_srv)
-                ok = target_info.get("status") == "OK" and self.send_remote(mail, target_info)
-            except Exception as e:
-                self.log.error(f"DNS or send error: {e}")
-                ok = False
+    def peer_overloaded(self, target_srv: str) -> bool:
+        try:
+            return self.resolver.resolve(target_srv).get("status") == "OVERLOAD"
+        except Exception:
+            return False
 
-            if ok:
-                self.log.info(f"Outbox delivered {mail['id']} to {target_srv}")
-            else:
-                if retries + 1 < self.max_retries:
-                    self.log.warning(f"Retrying mail {mail['id']} to {target_srv} (retry {retries + 1})")
-                    requeue.append((mail, target_srv, retries + 1))
+    def drain_destination(self, dest: Destination):
+        patient = self.outbox.deferred_for(dest) < self.max_defer
+        if patient and self.peer_overloaded(dest.name):
+            self.metrics.inc("outbox_deferred_total", reason="overload")
+            self.outbox.defer(dest, self.retry_delay)
+            self.log.info(f"<{dest.name}> is overloaded, deferring {len(dest.queue)} mail(s)")
+            return
+        while batch := self.outbox.next_batch(dest, self.batch_size):
+            try:
+                acks = self.deliver_remote([mail for mail, _, _ in batch], dest.name)
+            except PeerBusy as e:
+                if not patient:
+                    acks = [False] * len(batch)
+                else:
+                    self.metrics.inc("outbox_deferred_total", reason="busy")
+                    self.outbox.defer(dest, e.retry_after, batch)
+                    self.log.warning(f"<{dest.name}> is busy, retrying {len(batch)} mail(s) in {e.retry_after}s")
+                    return
+            retry, given_up = [], False
+            for (mail, target_srv, retries), ok in zip(batch, acks):
+                if ok:
+                    self.store.backend.out_done(mail["id"])
+                elif retries + 1 < self.max_retries:
+                    retry.append((mail, target_srv, retries + 1))
                 else:
                     self.log.error(f"Giving up on mail {mail['id']} after {self.max_retries} attempts")
-            self.outbox.task_done()
+                    self.store.backend.out_done(mail["id"])
+                    given_up = True
 
-        if requeue:
-            time.sleep(self.retry_delay)
-            for item in requeue:
-                self.outbox.put(item)
+            delivered = sum(acks)
+            self.metrics.inc("outbox_delivered_total", delivered)
+            self.metrics.inc("outbox_retries_total", len(retry))
+            self.metrics.inc("outbox_given_up_total", len(batch) - delivered - len(retry))
+            if delivered:
+                self.log.info(f"Outbox delivered {delivered} mail(s) to {dest.name}")
+            if retry:
+                at = self.outbox.retry(dest, retry)
+                self.log.warning(f"Retrying {len(retry)} mail(s) to {dest.name} in {at - time.monotonic():.1f}s")
+                return
+            if given_up:
+                self.outbox.fail(dest)
+                return
+            self.outbox.success(dest)
+
+    def process_outbox(self):
+        for dest in self.outbox.claim():
+            self.delivery_pool.submit(self.drain_destination, dest)
+
+    def watch_registry(self):
+        # Registry pushes replace polling: a peer going down drops its cached address at once,
+        # and one coming back is retried without waiting out its backoff.
+        since = None
+        while not self.stop_event.is_set():
+            try:
+                for event in DNSClient(self.dns_host, self.dns_port).watch(since):
+                    if self.stop_event.is_set():
+                        return
+                    since = event["version"]
+                    if "servers" in event:
+                        for name, info in event["servers"].items():
+                            self.resolver.update(name, info)
+                        for name in event.get("removed", ()):
+                            self.resolver.invalidate(name)
+                    elif "server" in event:
+                        name, info = event["server"], event["info"]
+                        if info is None:
+                            self.resolver.invalidate(name)
+                            continue
+                        self.resolver.update(name, info)
+                        if info.get("status") == "OK" and self.outbox.wake(name):
+                            self.log.info(f"<{name}> is back, retrying its outbox now")
+            except Exception as e:
+                self.log.warning(f"Registry watch lost: {e}")
+            self.stop_event.wait(self.retry_delay)
 
     def queue_loop(self):
+        # Sleeps until the outbox has work, accept() kicks it for new inbox mail, or a second passes.
         while not self.stop_event.is_set():
             self.process_inbox()
             self.process_outbox()
-            time.sleep(1)
+            self.outbox.wait(1)
 
-    def serve(self):
-        self.dns_register()
+    def serve(self, engine: str = "threaded"):
+        for mail, target_srv in self.store.recover():
+            self.outbox.put((mail, target_srv, 0))
+        # Workers are one logical server: only the outbox owner registers and follows the registry.
+        leader = self.workers is None or self.workers.owns_outbox
+        if leader:
+            self.dns_register()
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.settimeout(1.0)
+        if self.workers is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.bind(("0.0.0.0", self.port))
-        sock.listen()
-        self.log.info(f"Mail Server listening on 0.0.0.0:{self.port}")
+        sock.listen(socket.SOMAXCONN)
+        self.log.info(f"Mail Server listening on 0.0.0.0:{self.port} ({engine} engine)")
 
+        self.engine = AsyncEngine(self) if engine == "asyncio" else None
+        if self.workers is not None:
+            peer_sock, handoff_sock = self.workers.listen()
+            threading.Thread(target=self.serve_threaded, args=(peer_sock,), daemon=True).start()
+            threading.Thread(target=self.handoff_loop, args=(handoff_sock,), daemon=True).start()
         threading.Thread(target=self.queue_loop, daemon=True).start()
+        threading.Thread(target=self.peers.evict_loop, args=(self.stop_event,), daemon=True).start()
+        if leader:
+            threading.Thread(target=self.resolver.refresh_loop, args=(self.stop_event,), daemon=True).start()
+            threading.Thread(target=self.watch_registry, daemon=True).start()
+        if self.metrics_port:
+            self.metrics.serve(self.metrics_port)
 
-        while True:
+        try:
+            if self.engine is not None:
+                self.engine.run(sock)
+            else:
+                self.serve_threaded(sock)
+        except KeyboardInterrupt:
+            self.log.info("Mail Server shutting down…")
+        finally:
+            self.stop_event.set()
+            sock.close()
+            locks = self.store.locks.stats()
+            self.log.info(f"Mailbox locks: {locks['acquired']} acquired, {locks['contended']} contended "
+                          f"over {locks['stripes']} stripe(s)")
+            time.sleep(1)
+            self.peers.close()
+            self.dns.close()
+            self.store.backend.close()
+
+    def serve_threaded(self, sock: socket.socket):
+        while not self.stop_event.is_set():
             try:
                 conn, addr = sock.accept()
-                peek = conn.recv(4, socket.MSG_PEEK)
-                target = self.handler_remote if peek.startswith(b"PING") or peek[:1] == b"{" else self.handler_client
-                threading.Thread(target=target, args=(conn, addr), daemon=True).start()
+                threading.Thread(target=self.handler_connection, args=(conn, addr), daemon=True).start()
             except socket.timeout:
                 continue
-            except KeyboardInterrupt:
-                self.log.info("Mail Server shutting down…")
-                self.stop_event.set()
-                sock.close()
-                time.sleep(1)
-                break
+
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python server.py <server_name> <port>")
-        sys.exit(1)
-
-    name = sys.argv[1]
-    port = int(sys.argv[2])
-    server = MailServer(name, port)
-    server.serve()
+    parser = argparse.ArgumentParser(description="Mail server")
+    parser.add_argument("name")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("--dns", default="127.0.0.1:4000", help="registry address as host:port")
+    parser.add_argument("--stripes", type=int, default=64, help="mailbox lock stripes (1 = single global lock)")
+    parser.add_argument("--storage", choices=("memory", "log"), default="memory")
+    parser.add_argument("--data-dir", help="segment directory for --storage log (default: data/<name>)")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, default="always",
+                        help="always = group commit before replying, interval/never = background flush")
+    parser.add_argument("--outbox-workers", type=int, default=16, help="concurrent outbound deliveries")
+    parser.add_argument("--per-destination", type=int, default=1,
+                        help="concurrent deliveries per peer (1 keeps per-peer FIFO order)")
+    parser.add_argument("--dns-ttl", type=float, default=30.0, help="seconds to cache registry answers")
+    parser.add_argument("--batch-size", type=int, default=64, help="max mails per MAIL_BATCH transfer")
+    parser.add_argument("--peer-pool-size", type=int, default=4, help="idle connections kept per peer")
+    parser.add_argument("--peer-idle-timeout", type=float, default=60.0,
+                        help="seconds before an idle peer connection is closed")
+    parser.add_argument("--peer-health-interval", type=float, default=10.0,
+                        help="idle seconds after which a pooled peer connection is PINGed before reuse")
+    parser.add_argument("--inbox-watermarks", type=int, nargs=2, default=(10000, 8000), metavar=("HIGH", "LOW"),
+                        help="refuse peer transfers with BUSY above HIGH until the inbox drains to LOW")
+    parser.add_argument("--outbox-watermarks", type=int, nargs=2, default=(10000, 8000), metavar=("HIGH", "LOW"),
+                        help="answer remote SENDs with SEND_BUSY above HIGH until the outbox drains to LOW")
+    parser.add_argument("--session-watermarks", type=int, nargs=2, metavar=("HIGH", "LOW"),
+                        help="refuse new client sessions above HIGH until they drop to LOW (default: no limit)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus text metrics on this port (worker i uses port + i)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes sharing the port, mailboxes split between them by user")
+    args = parser.parse_args()
+    if args.storage == "log":
+        args.data_dir = args.data_dir or os.path.join("data", args.name)
+        check_data_dir(args.data_dir, args.workers)
+
+    if args.workers > 1:
+        spawn(args.workers, lambda workers: run(args, workers))
+    else:
+        run(args)
+
+
+def run(args, workers: WorkerGroup | None = None):
+    dns_host, dns_port = args.dns.rsplit(":", 1)
+    backend = None
+    if args.storage == "log":
+        backend = LogBackend(worker_data_dir(args.data_dir, workers.index if workers else 0), fsync=args.fsync)
+    metrics_port = args.metrics_port + workers.index if args.metrics_port and workers else args.metrics_port
+    server = MailServer(args.name, args.port, stripes=args.stripes, backend=backend,
+                        outbox_workers=args.outbox_workers, per_destination=args.per_destination,
+                        dns_ttl=args.dns_ttl, batch_size=args.batch_size,
+                        peer_pool_size=args.peer_pool_size, peer_idle_timeout=args.peer_idle_timeout,
+                        peer_health_interval=args.peer_health_interval,
+                        inbox_watermarks=tuple(args.inbox_watermarks),
+                        outbox_watermarks=tuple(args.outbox_watermarks),
+                        session_watermarks=args.session_watermarks and tuple(args.session_watermarks),
+                        metrics_port=metrics_port,
+                        dns_host=dns_host, dns_port=int(dns_port), workers=workers)
+    server.serve(args.engine)
+
 
 if __name__ == "__main__":
     main()
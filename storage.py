@@ -0,0 +1,331 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Iterator
+
+# Record layout: crc32(4) | payload length(4) | op(1) | lsn(8) | payload (JSON, maybe zlib)
+# The crc covers everything after itself, so a torn tail write is detected on recovery.
+CRC = struct.Struct("!I")
+RECORD = struct.Struct("!IBQ")
+RECORD_SIZE = CRC.size + RECORD.size
+
+OP_PUT, OP_DEL, OP_OUT, OP_OUT_DONE = 1, 2, 3, 4
+# Set on op when the JSON payload is zlib-compressed; compaction copies it through unchanged.
+OP_ZLIB = 0x80
+RECORD_COMPRESS_MIN = 512
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+
+class MemoryBackend:
+    durable = False
+
+    def open(self) -> tuple[list[tuple[str, dict]], list[tuple[dict, str]]]:
+        return [], []
+
+    def put(self, user: str, mail: dict) -> int:
+        return 0
+
+    def delete(self, user: str, mid: str) -> int:
+        return 0
+
+    def out_add(self, mail: dict, target: str) -> int:
+        return 0
+
+    def out_done(self, mid: str) -> int:
+        return 0
+
+    def commit(self, token: int):
+        pass
+
+    def close(self):
+        pass
+
+
+class LogBackend:
+    # Write-ahead journal for the mail store: it makes mailboxes and the outbox survive restarts,
+    # but READs are still served by the in-memory Mailbox rebuilt from it; segments are only
+    # read (mmapped) at recovery and compaction.
+    durable = True
+
+    def __init__(
+        self,
+        path: str,
+        fsync: str = "always",
+        fsync_interval: float = 0.005,
+        segment_size: int = 64 * 1024 * 1024,
+        compact_interval: float = 60.0,
+        compact_ratio: float = 0.5,
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"unknown fsync policy: {fsync}")
+        self.path = path
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.segment_size = segment_size
+        self.compact_interval = compact_interval
+        self.compact_ratio = compact_ratio
+        self.log = logging.getLogger("storage")
+
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+        # segment number -> [bytes written, bytes no longer needed]
+        self._segments: dict[int, list[int]] = {}
+        self._active = None
+        self._active_no = 0
+        self._lsn = 0
+        self._appended = 0
+        self._durable = 0
+
+        # live record locations: (seg, offset, size)
+        self._mails: dict[tuple[str, str], tuple[int, int, int]] = {}
+        self._outbound: dict[str, tuple[int, int, int]] = {}
+
+    @staticmethod
+    def _decode(op: int, payload: bytes) -> tuple[int, dict]:
+        if op & OP_ZLIB:
+            payload = zlib.decompress(payload)
+        return op & ~OP_ZLIB, json.loads(payload)
+
+    def _seg_path(self, no: int) -> str:
+        return os.path.join(self.path, f"{no:08d}.seg")
+
+    def _scan(self, no: int) -> Iterator[tuple[int, int, int, bytes, int]]:
+        with open(self._seg_path(no), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                off, end = 0, len(mm)
+                while off + RECORD_SIZE <= end:
+                    (crc,) = CRC.unpack_from(mm, off)
+                    length, op, lsn = RECORD.unpack_from(mm, off + CRC.size)
+                    size = RECORD_SIZE + length
+                    if off + size > end:
+                        return
+                    if zlib.crc32(mm[off + CRC.size:off + size]) != crc:
+                        return
+                    yield off, op, lsn, mm[off + RECORD_SIZE:off + size], size
+                    off += size
+
+    def open(self) -> tuple[list[tuple[str, dict]], list[tuple[dict, str]]]:
+        os.makedirs(self.path, exist_ok=True)
+        nos = sorted(int(f[:-4]) for f in os.listdir(self.path) if f.endswith(".seg"))
+        puts: dict[tuple[str, str], tuple[int, str, dict]] = {}
+        outs: dict[str, tuple[int, dict, str]] = {}
+
+        for no in nos:
+            size = os.path.getsize(self._seg_path(no))
+            self._segments[no] = [size, 0]
+            end = 0
+            for off, op, lsn, payload, rsize in self._scan(no):
+                end = off + rsize
+                self._lsn = max(self._lsn, lsn)
+                op, rec = self._decode(op, payload)
+                if op == OP_PUT:
+                    key = (rec["u"], rec["m"]["id"])
+                    self._kill(self._mails.pop(key, None))
+                    self._mails[key] = (no, off, rsize)
+                    puts[key] = (lsn, rec["u"], rec["m"])
+                elif op == OP_DEL:
+                    key = (rec["u"], rec["id"])
+                    self._kill(self._mails.pop(key, None))
+                    puts.pop(key, None)
+                    self._segments[no][1] += rsize
+                elif op == OP_OUT:
+                    mid = rec["m"]["id"]
+                    self._kill(self._outbound.pop(mid, None))
+                    self._outbound[mid] = (no, off, rsize)
+                    outs[mid] = (lsn, rec["m"], rec["t"])
+                elif op == OP_OUT_DONE:
+                    self._kill(self._outbound.pop(rec["id"], None))
+                    outs.pop(rec["id"], None)
+                    self._segments[no][1] += rsize
+
+            if end < size:
+                self.log.warning(f"Segment {no}: truncating {size - end} torn byte(s)")
+                with open(self._seg_path(no), "r+b") as f:
+                    f.truncate(end)
+                self._segments[no][0] = end
+
+        self._open_segment((nos[-1] + 1) if nos else 1)
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        if self.compact_interval:
+            threading.Thread(target=self._compact_loop, daemon=True).start()
+
+        self.log.info(f"Recovered {len(puts)} mail(s), {len(outs)} outbound from {len(nos)} segment(s)")
+        mails = [(user, mail) for _, user, mail in sorted(puts.values(), key=lambda p: p[0])]
+        pending = [(mail, target) for _, mail, target in sorted(outs.values(), key=lambda o: o[0])]
+        return mails, pending
+
+    def _open_segment(self, no: int):
+        self._active = open(self._seg_path(no), "ab")
+        self._active_no = no
+        self._segments[no] = [0, 0]
+
+    def _roll(self):
+        self._active.flush()
+        os.fsync(self._active.fileno())
+        self._active.close()
+        self._open_segment(self._active_no + 1)
+
+    def _kill(self, loc: tuple[int, int, int] | None):
+        if loc is not None and loc[0] in self._segments:
+            self._segments[loc[0]][1] += loc[2]
+
+    def _write(self, op: int, lsn: int, payload: bytes) -> tuple[int, int, int]:
+        size = RECORD_SIZE + len(payload)
+        stat = self._segments[self._active_no]
+        if stat[0] and stat[0] + size > self.segment_size:
+            self._roll()
+            stat = self._segments[self._active_no]
+
+        head = RECORD.pack(len(payload), op, lsn)
+        crc = zlib.crc32(payload, zlib.crc32(head))
+        self._active.write(CRC.pack(crc) + head)
+        self._active.write(payload)
+
+        loc = (self._active_no, stat[0], size)
+        stat[0] += size
+        self._appended += 1
+        self._wake.set()
+        return loc
+
+    def _append(self, op: int, rec: dict) -> tuple[int, int, int]:
+        self._lsn += 1
+        payload = json.dumps(rec, separators=(",", ":")).encode()
+        if len(payload) >= RECORD_COMPRESS_MIN:
+            packed = zlib.compress(payload, 1)
+            if len(packed) < len(payload):
+                op, payload = op | OP_ZLIB, packed
+        return self._write(op, self._lsn, payload)
+
+    def put(self, user: str, mail: dict) -> int:
+        with self._lock:
+            key = (user, mail["id"])
+            self._kill(self._mails.pop(key, None))
+            self._mails[key] = self._append(OP_PUT, {"u": user, "m": mail})
+            return self._appended
+
+    def delete(self, user: str, mid: str) -> int:
+        with self._lock:
+            loc = self._mails.pop((user, mid), None)
+            if loc is None:
+                return 0
+            self._kill(loc)
+            self._kill(self._append(OP_DEL, {"u": user, "id": mid, "s": loc[0]}))
+            return self._appended
+
+    def out_add(self, mail: dict, target: str) -> int:
+        with self._lock:
+            self._kill(self._outbound.pop(mail["id"], None))
+            self._outbound[mail["id"]] = self._append(OP_OUT, {"m": mail, "t": target})
+            return self._appended
+
+    def out_done(self, mid: str) -> int:
+        with self._lock:
+            loc = self._outbound.pop(mid, None)
+            if loc is None:
+                return 0
+            self._kill(loc)
+            self._kill(self._append(OP_OUT_DONE, {"id": mid, "s": loc[0]}))
+            return self._appended
+
+    def commit(self, token: int):
+        if self.fsync != "always" or not token:
+            return
+        with self._synced:
+            while self._durable < token and not self._stop.is_set():
+                self._synced.wait(1.0)
+
+    # Group commit: every caller that appended before the flush shares one fsync.
+    def _sync(self, force: bool = False):
+        with self._lock:
+            target = self._appended
+            if self._active.closed or (target == self._durable and not force):
+                return
+            self._active.flush()
+            fd = os.dup(self._active.fileno())
+        try:
+            if self.fsync != "never" or force:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        with self._synced:
+            self._durable = max(self._durable, target)
+            self._synced.notify_all()
+
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            if self.fsync == "always":
+                self._wake.wait()
+                self._wake.clear()
+            else:
+                time.sleep(self.fsync_interval)
+            try:
+                self._sync()
+            except Exception as e:
+                self.log.exception(f"Flush error: {e}")
+
+    def _compact_loop(self):
+        while not self._stop.wait(self.compact_interval):
+            try:
+                self.compact()
+            except Exception as e:
+                self.log.exception(f"Compaction error: {e}")
+
+    def compact(self) -> int:
+        with self._lock:
+            candidates = [
+                no for no, (size, dead) in self._segments.items()
+                if no != self._active_no and (size == 0 or dead / size >= self.compact_ratio)
+            ]
+        for no in candidates:
+            self._compact_segment(no)
+        return len(candidates)
+
+    def _live(self, no: int, off: int, op: int, rec: dict) -> bool:
+        if op == OP_PUT:
+            loc = self._mails.get((rec["u"], rec["m"]["id"]))
+            return loc is not None and loc[:2] == (no, off)
+        if op == OP_OUT:
+            loc = self._outbound.get(rec["m"]["id"])
+            return loc is not None and loc[:2] == (no, off)
+        # Tombstones only matter while the segment holding their target still exists.
+        return rec["s"] != no and rec["s"] in self._segments
+
+    def _compact_segment(self, no: int):
+        moved = 0
+        for off, raw_op, lsn, payload, size in self._scan(no):
+            op, rec = self._decode(raw_op, payload)
+            with self._lock:
+                if not self._live(no, off, op, rec):
+                    continue
+                loc = self._write(raw_op, lsn, payload)
+                if op == OP_PUT:
+                    self._mails[(rec["u"], rec["m"]["id"])] = loc
+                elif op == OP_OUT:
+                    self._outbound[rec["m"]["id"]] = loc
+                else:
+                    self._kill(loc)
+                moved += 1
+
+        self._sync(force=True)
+        with self._lock:
+            size = self._segments.pop(no)[0]
+        os.remove(self._seg_path(no))
+        self.log.info(f"Compacted segment {no}: kept {moved} record(s) of {size} byte(s)")
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        self._sync(force=True)
+        with self._lock:
+            self._active.close()
@@ -0,0 +1,38 @@
+import itertools
+import threading
+
+from mailid import SEQ_MASK, MailIdGenerator, timestamp_ms
+
+
+def test_ids_stay_ordered_across_a_sequence_wrap():
+    gen = MailIdGenerator("S1")
+    gen._seq = itertools.count(SEQ_MASK - 2)
+    ids = [gen() for _ in range(8)]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+    # ids[3] is the first past the wrap: it carries into the millisecond part.
+    assert timestamp_ms(ids[3]) > timestamp_ms(ids[2])
+
+
+def test_ids_are_unique_and_ordered_per_thread():
+    gen = MailIdGenerator("S1")
+    per_thread = [[] for _ in range(4)]
+
+    def run(out: list[str]):
+        for _ in range(20_000):
+            out.append(gen())
+
+    threads = [threading.Thread(target=run, args=(out,)) for out in per_thread]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert all(out == sorted(out) for out in per_thread)
+    assert len({mid for out in per_thread for mid in out}) == 80_000
+
+
+def test_nodes_do_not_collide_and_timestamps_read_back():
+    a, b = MailIdGenerator("S1"), MailIdGenerator("S2")
+    assert a() != b()
+    assert timestamp_ms(a()) is not None
+    assert timestamp_ms("mail_1700000000000") is None
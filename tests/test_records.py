@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+import records
+from records import FIELD_MAX, MailRecord
+
+
+def mail(subject: str = "hello", body: str = "body") -> dict:
+    return {"type": "MAIL_TRANSFER", "id": "mail_0001", "sender": "u1@S1", "receiver": "u2", "subject": subject,
+            "body": body, "date": "2026-01-01T00:00:00+00:00"}
+
+
+@pytest.mark.parametrize("subject", [
+    "a" * FIELD_MAX,
+    "é" * (FIELD_MAX // 2),
+    "\U0001F600" * (FIELD_MAX // 4),
+    "",
+])
+def test_round_trip_at_field_limit(subject):
+    m = mail(subject)
+    assert records.fits(m)
+    assert records.decode(records.encode(m))[0] == m
+    assert records.decode_batch(records.encode_batch([m, mail()])) == [m, mail()]
+
+
+@pytest.mark.parametrize("subject", [
+    "a" * (FIELD_MAX + 1),
+    "é" * (FIELD_MAX // 2 + 1),
+    "\U0001F600" * (FIELD_MAX // 4 + 1),
+])
+def test_field_over_limit_is_refused(subject):
+    m = mail(subject)
+    assert not records.fits(m)
+    with pytest.raises(ValueError):
+        records.encode(m)
+    with pytest.raises(ValueError):
+        records.encode_batch([mail(), m])
+
+
+def test_compressed_record_round_trip():
+    m = mail(body="compressible " * 100)
+    record = MailRecord.from_mail(m)
+    assert isinstance(record.body, bytes)
+    assert records.decode(records.encode(record))[0] == m
+    assert record.to_dict() == m
+
+
+def test_parse_read_accepts_json_and_binary():
+    m = mail()
+    assert records.parse_read(b"READ_OK::" + records.encode(m)) == m
+    assert records.parse_read(b"READ_OK::" + json.dumps(m).encode()) == m
+    assert records.parse_read(b"NOT_FOUND") is None
+
+
+def test_truncated_record():
+    with pytest.raises(ValueError):
+        records.decode(records.encode(mail())[:-1])
@@ -0,0 +1,121 @@
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import zlib
+from typing import Callable
+
+HANDOFF_MAX = 256 * 1024
+LAYOUT_FILE = "workers.json"
+
+
+class WorkerGroup:
+    # N processes of one logical server accept on the same port (SO_REUSEPORT). Mailboxes are
+    # split between them by user: a client whose user lives in another worker is handed to
+    # that worker at LOGIN, socket and all, over a Unix datagram socket. Workers forward mail
+    # to each other over Unix stream sockets speaking the peer protocol. Worker 0 owns the
+    # outbox and the registry entry.
+    def __init__(self, index: int, count: int, run_dir: str):
+        self.index = index
+        self.count = count
+        self.run_dir = run_dir
+
+    @property
+    def owns_outbox(self) -> bool:
+        return self.index == 0
+
+    def owner(self, user: str) -> int:
+        # crc32 rather than hash(): it has to agree across processes.
+        return zlib.crc32(user.encode()) % self.count
+
+    def owns(self, user: str) -> bool:
+        return self.owner(user) == self.index
+
+    def peer_path(self, index: int) -> str:
+        return os.path.join(self.run_dir, f"worker-{index}.sock")
+
+    def handoff_path(self, index: int) -> str:
+        return os.path.join(self.run_dir, f"worker-{index}.handoff")
+
+    def listen(self) -> tuple[socket.socket, socket.socket]:
+        peer = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        peer.settimeout(1.0)
+        peer.bind(self.peer_path(self.index))
+        peer.listen(socket.SOMAXCONN)
+        handoff = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        handoff.settimeout(1.0)
+        handoff.bind(self.handoff_path(self.index))
+        return peer, handoff
+
+    def hand_off(self, index: int, sock, state: dict, buffered: bytes = b""):
+        # The kernel duplicates the descriptor into the receiver; the caller closes its own copy.
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+            s.connect(self.handoff_path(index))
+            socket.send_fds(s, [json.dumps(state).encode(), b"\0", buffered], [sock.fileno()])
+
+    def receive(self, handoff: socket.socket) -> tuple[socket.socket, dict, bytes]:
+        msg, fds, _, _ = socket.recv_fds(handoff, HANDOFF_MAX, 1)
+        if not fds:
+            raise ConnectionError("handoff without a socket")
+        head, _, buffered = msg.partition(b"\0")
+        return socket.socket(fileno=fds[0]), json.loads(head), buffered
+
+
+def worker_data_dir(root: str, index: int) -> str:
+    return os.path.join(root, f"worker-{index}")
+
+
+def check_data_dir(root: str, count: int):
+    # Journals are split per worker by crc32(user) % count, so a data dir only recovers all its
+    # mail under the worker count that wrote it. The count is recorded on first start and a
+    # different one is refused. A single process uses the same layout, with just worker-0.
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, LAYOUT_FILE)
+    try:
+        with open(path) as f:
+            written = json.load(f)["workers"]
+    except FileNotFoundError:
+        written = None
+        names = os.listdir(root)
+        segments = [n for n in names if n.endswith(".seg")]
+        if segments:
+            # Written by a single process before the layout file: move it into worker-0.
+            os.makedirs(worker_data_dir(root, 0), exist_ok=True)
+            for name in segments:
+                os.rename(os.path.join(root, name), os.path.join(worker_data_dir(root, 0), name))
+            written = 1
+        elif any(n.startswith("worker-") for n in names):
+            written = sum(n.startswith("worker-") for n in names)
+    if written is not None and written != count:
+        raise SystemExit(f"{root} holds mail split across {written} worker(s); start with --workers {written} "
+                         f"(or move the data away)")
+    if not os.path.exists(path):
+        with open(path, "w") as f:
+            json.dump({"workers": count}, f)
+
+
+def spawn(count: int, target: Callable[[WorkerGroup], None]):
+    # Forks one process per worker and waits for them. SIGTERM is passed on; Ctrl-C already
+    # reaches every worker through the process group.
+    run_dir = tempfile.mkdtemp(prefix="mail-workers-")
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=target, args=(WorkerGroup(i, count, run_dir),), name=f"worker-{i}")
+             for i in range(count)]
+
+    def stop(signum, frame):
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+
+    for proc in procs:
+        proc.start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        for proc in procs:
+            proc.join()
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)